@@ -1,20 +1,52 @@
-import h5py
 import pandas as pd
 import pathlib
 import ast
 import sys
 from math import sin, ceil, floor
 import numpy as np
+import scipy.sparse as sp
 from collections import defaultdict, Counter
 from sklearn.neighbors import KDTree
-import pickle
+import multiprocessing
 
 import torch
 from torch_sparse import SparseTensor
 
 import data_utils as utils
+import tripstore
+from constants import Constants
 from preprocessing import SpatialRegion
 
+# grid parameters a make_transition_graph worker needs to tokenize trips through the cell2vocab table
+TRANSITION_WORKER_ATTRS = ["dataset_name", "minlon", "minlat", "maxlon", "maxlat", "minx", "miny", "maxx", "maxy",
+                           "xstep", "ystep", "numx", "numy", "vocab_start", "vocab_size", "built"]
+_transition_region = None
+
+def _init_transition_worker(grid, cell2vocab, hotcell):
+    """
+    make_transition_graph pool initializer : a bare region holding only the grid parameters,
+    the cell2vocab table and the hotcells, sent once per worker instead of the whole region per job
+    """
+    global _transition_region
+    region = GraphRegion.__new__(GraphRegion)
+    region.__dict__.update(grid)
+    region.cell2vocab, region.hotcell = cell2vocab, hotcell
+    region._hotcell2vocab = region._vocab2hotcell = region._hotcell_kdtree = region._cellcount = None
+    _transition_region = region
+
+def _count_transitions(args):
+    """
+    make_transition_graph worker : unique encoded movements and their counts in the trips numbered start~stop
+    """
+    trips_path, start, stop, zerolen_tripids = args
+    region = _transition_region
+    trips = [trip for _, trip in tripstore.iter_trips(trips_path, zerolen_tripids, stop=stop, start=start)
+             if trip.shape[1] > 1]
+    if len(trips) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), 0
+    keys, counts = region.transition_keys(trips, region.vocab_size - region.vocab_start, return_counts=True)
+    return keys, counts, len(trips)
+
 class GraphRegion(SpatialRegion):
     def __init__(self, dataset_name, minlon, minlat, maxlon, maxlat, 
                  xstep, ystep, 
@@ -32,25 +64,6 @@ class GraphRegion(SpatialRegion):
     def save_graphregion_info(self, data_dir, path):
         pass
         
-    def load_spatialregion_info(self, data_dir, fname):
-        """
-        load the following region info from .pkl file: 'cellcount', 'hotcell', 
-        'hotcell2vocab', 'vocab2hotcell','vocab_size', 'hotcell_kdtree', 'built'
-        7 in total
-
-        load_spatialregion_info(data_dir, "portomap.pkl")
-        """
-        file_path = data_dir/self.dataset_name/"region_info"/fname
-        info = pickle.load(open(file_path, "rb"))
-        
-        self.cellcount= info["cellcount"]
-        self.hotcell= info["hotcell"]
-        self.hotcell2vocab= info["hotcell2vocab"]
-        self.vocab2hotcell= info["vocab2hotcell"]
-        self.vocab_size= info["vocab_size"]
-        self.hotcell_kdtree= info["hotcell_kdtree"]
-        self.built= True
-        
     def load_graphregion_info(self, data_dir, spatialregion_fname, adj_fname):
         """
         load the adj matrix
@@ -63,49 +76,264 @@ class GraphRegion(SpatialRegion):
         #         adjmatrix = pickle.load(open(file_path, "r"))
         self.adjmatrix = adjmatrix
         
-    def make_adjmatrix(self, data_dir, fname, zerolen_tripids=None):
+    def iter_transition_keys(self, file_path, zerolen_tripids=None, chunk_size=100000):
+        """
+        yield, for chunks of chunk_size trips, the unique movements between consecutive vocabs
+        encoded as one integer (prev-vocab_start)*n + (curr-vocab_start), n = vocab_size-vocab_start;
+        movements from/to UNK and self loops are left out
+        """
+        n = self.vocab_size - self.vocab_start
+        trips = []
+        for i, (num, trip) in enumerate(tripstore.iter_trips(file_path, zerolen_tripids, chunk_size=chunk_size)):
+            if i % 3000 == 2999 : 
+                print("Scanned {} trips".format(i+1))
+            if trip.shape[1] > 1 : trips.append(trip) # bc there cannot be any connention otherwise
+            if len(trips) == chunk_size:
+                yield self.transition_keys(trips, n)
+                trips = []
+        if len(trips) > 0:
+            yield self.transition_keys(trips, n)
+    
+    def transition_keys(self, trips, n, return_counts=False):
+        vocabs, offsets = self.trips2seqs(trips)
+        pre, curr = vocabs[:-1], vocabs[1:]
+        # no movement across two trips
+        inside = np.ones(len(pre), dtype=bool)
+        inside[offsets[1:-1]-1] = False
+        keep = inside & (pre != Constants.UNK) & (curr != Constants.UNK) & (pre != curr)
+        return np.unique((pre[keep]-self.vocab_start)*n + (curr[keep]-self.vocab_start), return_counts=return_counts)
+    
+    def make_transition_graph(self, data_dir, fname, zerolen_tripids=None, processes=None, chunk_size=50000):
+        """
+        transition counts between hot vocabs in one parallel scan of the trips :
+        workers count the encoded movements (see iter_transition_keys) of chunk_size trips each,
+        the counts are summed here
+        @param processes : workers, 1 scans in this process
+        return self.transition_counts : (n, n) CSR int64 number of movements prev -> curr,
+               self.transition_probs : (n, n) CSR float64, counts normalized by row
+               with n = vocab_size-vocab_start, UNK and self loops excluded as in make_adjmatrix
+        """
+        file_path = data_dir/self.dataset_name/fname
+        n = self.vocab_size - self.vocab_start
+        jobs = [(file_path, start, stop, zerolen_tripids)
+                for start, stop in tripstore.tripnum_ranges(file_path, chunk_size)]
+        if getattr(self, "cell2vocab", None) is None:
+            self.build_cell2vocab()
+        initargs = ({name:getattr(self, name) for name in TRANSITION_WORKER_ATTRS},
+                    self.cell2vocab, np.asarray(self.hotcell))
+        
+        keys, counts = np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        pool = multiprocessing.Pool(processes=processes, initializer=_init_transition_worker, initargs=initargs) \
+               if processes != 1 and len(jobs) > 1 else None
+        if pool is None:
+            _init_transition_worker(*initargs)
+        results = pool.imap(_count_transitions, jobs) if pool is not None else map(_count_transitions, jobs)
+        try:
+            for i, (chunk_keys, chunk_counts, n_trips) in enumerate(results):
+                keys, inv = np.unique(np.concatenate([keys, chunk_keys]), return_inverse=True)
+                counts = np.bincount(inv, weights=np.concatenate([counts, chunk_counts]), 
+                                     minlength=len(keys)).astype(np.int64)
+                print("Scanned {} chunks of {} trips".format(i+1, len(jobs)))
+        finally:
+            if pool is not None:
+                pool.terminate()
+        
+        # sorted keys : already in CSR order
+        row, col = keys // n, keys % n
+        indptr = np.zeros(n+1, dtype=np.int64)
+        np.cumsum(np.bincount(row, minlength=n), out=indptr[1:])
+        self.transition_counts = sp.csr_matrix((counts, col.astype(np.int32), indptr), shape=(n, n))
+        rowsum = np.asarray(self.transition_counts.sum(axis=1)).ravel()
+        probs = counts / np.repeat(rowsum, np.diff(indptr))
+        self.transition_probs = sp.csr_matrix((probs, col.astype(np.int32), indptr), shape=(n, n))
+        return self.transition_counts, self.transition_probs
+    
+    def save_transition_graph(self, data_dir, fname):
+        """
+        fname = "entire_porto_transitions.npz" in region_info : indptr, indices, counts, probs
+        """
+        path = data_dir/self.dataset_name/"region_info"/fname
+        np.savez(path, indptr=self.transition_counts.indptr, indices=self.transition_counts.indices,
+                 counts=self.transition_counts.data, probs=self.transition_probs.data,
+                 shape=np.array(self.transition_counts.shape))
+    
+    def load_transition_graph(self, data_dir, fname):
+        f = np.load(data_dir/self.dataset_name/"region_info"/fname)
+        shape = tuple(f["shape"])
+        self.transition_counts = sp.csr_matrix((f["counts"], f["indices"], f["indptr"]), shape=shape)
+        self.transition_probs = sp.csr_matrix((f["probs"], f["indices"], f["indptr"]), shape=shape)
+        return self.transition_counts, self.transition_probs
+    
+    def make_adjmatrix(self, data_dir, fname, zerolen_tripids=None, chunk_size=100000):
         """
         @fname :: trips f : "preprocessed_entire_porto.h5"
         ex) f["trips/{}".format(num)] where the num is bet 1~all including zerolen_trips
+            or the ragged layout of tripstore.py
+        
+        the (vocab_size-vocab_start)^2 adjacency between hot vocabs (UNK and self loops excluded) is built 
+        sparse from the unique movements of every chunk_size trips; the dense matrix never exists
+        return self.adj_matrix : SparseTensor with 1. for every movement
         
         make_adjmatrix(data_dir, "preprocessed_entire_porto.h5",)
         """
         file_path = data_dir/self.dataset_name/fname
-        seq_vocabs = open(file_path, "r")
         
         # nodes ~ vocabs : self.vocab_start ~ self.vocab_size
-        nodes = list(range(self.vocab_size))
-        adj_matrix = np.zeros((len(nodes), len(nodes)),) # (nodes,nodes)
-#         print(adj_matrix.shape)
+        n = self.vocab_size - self.vocab_start
+        keys = np.empty(0, dtype=np.int64)
+        pending = []
+        for chunk_keys in self.iter_transition_keys(file_path, zerolen_tripids, chunk_size=chunk_size):
+            pending.append(chunk_keys)
+            if sum(map(len, pending)) > 4 * max(len(keys), chunk_size):
+                keys = np.unique(np.concatenate([keys] + pending))
+                pending = []
+        keys = np.unique(np.concatenate([keys] + pending)) # sorted : row-major order
+        
+        row, col = keys // n, keys % n
+        self.adj_matrix = SparseTensor(row=torch.from_numpy(row), col=torch.from_numpy(col),
+                                       value=torch.ones(len(keys), dtype=torch.float64),
+                                       sparse_sizes=(n, n))
+        return self.adj_matrix
+    
+    @staticmethod
+    def adj2csr(adj):
+        """
+        SparseTensor (or scipy sparse matrix) -> scipy CSR boolean matrix with int32 indices
+        """
+        if isinstance(adj, SparseTensor):
+            row, col, _ = adj.coo()
+            adj = sp.csr_matrix((np.ones(len(row), dtype=bool), (row.numpy(), col.numpy())),
+                                shape=adj.sparse_sizes())
+        adj = sp.csr_matrix(adj, dtype=bool)
+        adj.sum_duplicates()
+        adj.indices = adj.indices.astype(np.int32)
+        return adj
+    
+    @staticmethod
+    def csr2sparsetensor(csr):
+        csr = csr.tocsr()
+        return SparseTensor(rowptr=torch.from_numpy(csr.indptr.astype(np.int64)),
+                            col=torch.from_numpy(csr.indices.astype(np.int64)),
+                            value=torch.ones(csr.nnz, dtype=torch.float64),
+                            sparse_sizes=csr.shape)
+    
+    @staticmethod
+    def drop_diagonal(block, row_start):
+        """
+        remove the entries (i, row_start+i) of a CSR block of rows
+        """
+        rows = np.repeat(np.arange(block.shape[0]), np.diff(block.indptr))
+        keep = block.indices != rows + row_start
+        indptr = np.zeros(block.shape[0]+1, dtype=np.int64)
+        np.cumsum(np.bincount(rows[keep], minlength=block.shape[0]), out=indptr[1:])
+        return sp.csr_matrix((block.data[keep], block.indices[keep], indptr), shape=block.shape)
+    
+    def make_khop_adjmatrices(self, k, adj=None, block_rows=None, self_loops=False):
+        """
+        cumulative reachability within 1, 1~2, ..., 1~k hops : R_1 = A, R_h = R_{h-1} | R_{h-1} @ A
+        with sparse boolean products
+        @param adj : base adjacency, default self.adj_matrix (make_adjmatrix) or self.adjmatrix (loaded)
+        @param block_rows : rows computed at once, None for all; a block of rows of R_h only needs 
+                            the same rows of R_{h-1} and A, which bounds the memory of 3, 4-hop products
+        @param self_loops : keep the node->itself reachability through cycles
+        return [R_1, ..., R_k] as scipy CSR boolean matrices with int32 indices
+        """
+        if adj is None:
+            adj = getattr(self, "adj_matrix", None)
+            if adj is None:
+                adj = self.adjmatrix
+        adj = self.adj2csr(adj)
+        n = adj.shape[0]
+        block_rows = n if block_rows is None else block_rows
         
-        with h5py.File(file_path, 'r') as f:
-            total_len = len(f["trips"].keys())
-            for num in range(total_len):
-                
-                if num % 3000 == 2999 : 
-                    print("Scanned {} trips out of {}".format(num+1, total_len))
-                    
-                if num+1 in set(zerolen_tripids): continue
-                    
-                trip = f["trips/"+str(num+1)][()] # nd.array (2,traj_len)
-                
-                if trip.shape[1] ==1 : continue # bc there cannot be any connention
-                try:
-                    trip = np.array(self.trip2seq(trip)) # seq of vocabs : (len_trip)
-                    trip_pre, trip_curr = trip[:-1], trip[1:]
-                    conn = np.array([[pre, curr] for pre, curr in zip(trip_pre, trip_curr)])
-                    conn = np.unique(conn, axis=0) #(#conn, 2)
-                    adj_matrix[conn[:,0],conn[:,1]] = 1
-                        
-                except:
-                    conn = conn[np.all(conn!='UNK', axis=1)].astype(int) # (#conn, 2)
-                    adj_matrix[conn[:,0],conn[:,1]] = 1
-                
-        adj_matrix = adj_matrix[self.vocab_start:,self.vocab_start:]
-        adj_matrix[np.arange(adj_matrix.shape[0]),np.arange(adj_matrix.shape[0])] = 0
-        self.adj_matrix = SparseTensor.from_dense(torch.from_numpy(adj_matrix))
+        blocks = [[] for _ in range(k)]
+        for s in range(0, n, block_rows):
+            e = min(s + block_rows, n)
+            reach = adj[s:e]
+            for h in range(k):
+                if h > 0:
+                    reach = (reach + reach @ adj).tocsr()
+                blocks[h].append(reach if self_loops else self.drop_diagonal(reach, s))
+            print("{} hops of rows {} ~ {} done".format(k, s, e))
         
-        return adj_matrix
+        khops = []
+        for h in range(k):
+            khop = sp.vstack(blocks[h], format="csr", dtype=bool)
+            khop.indices = khop.indices.astype(np.int32)
+            khops.append(khop)
+            blocks[h] = None
+        return khops
+    
+    def build_neighbor_index(self, adj=None):
+        """
+        CSR (out-neighbors) and CSC (in-neighbors) index of the vocab graph, nodes are vocab-vocab_start
+        @param adj : default self.adj_matrix (make_adjmatrix) or self.adjmatrix (loaded)
+        """
+        if adj is None:
+            adj = getattr(self, "adj_matrix", None)
+            if adj is None:
+                adj = self.adjmatrix
+        csr = self.adj2csr(adj)
+        csc = csr.tocsc()
+        csc.sort_indices()
+        self.out_indptr, self.out_indices = csr.indptr.astype(np.int64), csr.indices.astype(np.int32)
+        self.in_indptr, self.in_indices = csc.indptr.astype(np.int64), csc.indices.astype(np.int32)
+    
+    def neighbor_index(self, direction):
+        if getattr(self, "out_indptr", None) is None:
+            self.build_neighbor_index()
+        if direction == "out":
+            return self.out_indptr, self.out_indices
+        elif direction == "in":
+            return self.in_indptr, self.in_indices
+        raise ValueError("direction is 'out' or 'in', not {}".format(direction))
+    
+    def out_neighbors(self, node):
+        """
+        sorted nodes reached from node in one movement, a view of the index
+        """
+        indptr, indices = self.neighbor_index("out")
+        return indices[indptr[node]:indptr[node+1]]
+    
+    def in_neighbors(self, node):
+        """
+        sorted nodes from which node is reached in one movement, a view of the index
+        """
+        indptr, indices = self.neighbor_index("in")
+        return indices[indptr[node]:indptr[node+1]]
+    
+    def gather_neighbors(self, nodes, direction="out"):
+        """
+        neighbors of many nodes at once
+        return neighbors : (sum of degrees,) int32, offsets : (len(nodes)+1,) ;
+               neighbors of nodes[i] are neighbors[offsets[i]:offsets[i+1]]
+        """
+        indptr, indices = self.neighbor_index(direction)
+        nodes = np.asarray(nodes, dtype=np.int64)
+        starts, lengths = indptr[nodes], indptr[nodes+1] - indptr[nodes]
+        offsets = np.zeros(len(nodes)+1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        return indices[tripstore.ragged_gather(starts, lengths)], offsets
+    
+    def common_neighbors(self, prev_node, next_node):
+        """
+        nodes v with prev_node -> v -> next_node, i.e. out_neighbors(prev_node) & in_neighbors(next_node)
+        """
+        return np.intersect1d(self.out_neighbors(prev_node), self.in_neighbors(next_node), assume_unique=True)
+    
+    @staticmethod
+    def khop_fname(prefix, hop):
+        """
+        names read by create_trainval_edit.py : entire_porto_sparseadj1hop.pt, entire_porto_sparseadj1_2hop.pt, ...
+        """
+        return "{}_sparseadj1hop.pt".format(prefix) if hop == 1 else "{}_sparseadj1_{}hop.pt".format(prefix, hop)
+    
+    def save_khop_adjmatrices(self, khops, data_dir, prefix="entire_porto"):
+        """
+        save [R_1, ..., R_k] of make_khop_adjmatrices as SparseTensor .pt files in region_info
+        """
+        for hop, khop in enumerate(khops, 1):
+            self.save_adjmatrix(self.csr2sparsetensor(khop), data_dir, self.dataset_name, self.khop_fname(prefix, hop))
     
     @classmethod
     def save_adjmatrix(cls, adj_matrix, data_dir, ds_name, fname):
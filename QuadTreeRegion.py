@@ -0,0 +1,154 @@
+import heapq
+from math import ceil, log2
+import numpy as np
+
+from preprocessing import SpatialRegion
+
+class QuadTreeRegion(SpatialRegion):
+    """
+    SpatialRegion whose vocabs are quadtree blocks of the xstep x ystep grid instead of single cells:
+    starting from one block covering the grid, the block with the most points is split into its
+    4 children until maxvocab_size blocks are reached, so dense areas get fine blocks and sparse
+    areas keep coarse ones instead of collapsing to UNK.
+
+    a block of level l is 2**l x 2**l cells and its id ("hotcell") is l*numx*numy + (its lower-left cell),
+    so level 0 blocks are plain cells. gps2vocab, trip2seq, cells2vocabs go through the dense
+    cell2vocab table as in SpatialRegion, knearest_hotcells works on block ids.
+    """
+    def __init__(self, dataset_name, minlon, minlat, maxlon, maxlat,
+                 xstep, ystep,
+                 minfreq=50, maxvocab_size=50000, knn_k=5,
+                 vocab_start=4, max_level=None,
+                ):
+        """
+        @param minfreq : blocks with less points are neither split nor kept as vocabs
+        @param maxvocab_size : target number of blocks
+        @param max_level : level of the root blocks, default one block covering the grid
+        """
+        super(QuadTreeRegion, self).__init__(dataset_name,
+                                             minlon, minlat, maxlon, maxlat,
+                                             xstep, ystep,
+                                             minfreq=minfreq, maxvocab_size=maxvocab_size,
+                                             knn_k=knn_k, vocab_start=vocab_start,)
+        if max_level is None:
+            max_level = max(0, ceil(log2(max(self.numx, self.numy))))
+        self.max_level = max_level
+
+    def block_id(self, level, by, bx):
+        size = 2 ** level
+        return level * self.numx * self.numy + (by * size) * self.numx + bx * size
+
+    def block_of(self, cell_id):
+        """
+        return level, row offset, column offset (in cells) and size (in cells) of block ids
+        """
+        cell_id = np.asarray(cell_id, dtype=np.int64)
+        level = cell_id // (self.numx * self.numy)
+        base = cell_id % (self.numx * self.numy)
+        return level, base // self.numx, base % self.numx, 2 ** level
+
+    def cell2coord(self, cell_id):
+        """
+        center of a block in meter metric; cells are level 0 blocks
+        """
+        _, yoffset, xoffset, size = self.block_of(cell_id)
+        y = self.miny + (yoffset + size / 2) * self.ystep
+        x = self.minx + (xoffset + size / 2) * self.xstep
+        return x, y
+
+    def count_pyramid(self, counts):
+        """
+        @param counts : (numx*numy,) points per cell
+        return [counts of level 0 blocks, ..., counts of max_level blocks] as 2d (rows, cols) arrays
+        """
+        side = 2 ** self.max_level
+        grid = np.zeros((ceil(self.numy / side) * side, ceil(self.numx / side) * side), dtype=np.int64)
+        grid[:self.numy, :self.numx] = np.asarray(counts).reshape(self.numy, self.numx)
+        pyramid = [grid]
+        for _ in range(self.max_level):
+            g = pyramid[-1]
+            pyramid.append(g[0::2, 0::2] + g[0::2, 1::2] + g[1::2, 0::2] + g[1::2, 1::2])
+        return pyramid
+
+    def select_hotcells(self, counts, seen):
+        """
+        split the densest block while the number of blocks with >= minfreq points stays <= maxvocab_size
+        return the block ids by descending count
+        """
+        pyramid = self.count_pyramid(counts)
+        # heap of (-count, level, by, bx) : the densest block first, ties by position
+        heap = [(-c, self.max_level, by, bx) for (by, bx), c in np.ndenumerate(pyramid[-1]) if c > 0]
+        heapq.heapify(heap)
+        leaves = []
+        nkept = sum(1 for c, *_ in heap if -c >= self.minfreq)
+        while heap:
+            c, level, by, bx = heapq.heappop(heap)
+            if level == 0 or -c < self.minfreq:
+                leaves.append((c, level, by, bx))
+                continue
+            children = [(-int(pyramid[level-1][y, x]), level-1, y, x)
+                        for y in (2*by, 2*by+1) for x in (2*bx, 2*bx+1) if pyramid[level-1][y, x] > 0]
+            nchildren = sum(1 for cc, *_ in children if -cc >= self.minfreq)
+            if nchildren == 0:
+                # splitting would only leave blocks under minfreq
+                leaves.append((c, level, by, bx))
+                continue
+            if nkept - 1 + nchildren > self.maxvocab_size:
+                # the densest block cannot be split any more
+                leaves.append((c, level, by, bx))
+                leaves.extend(heap)
+                break
+            nkept += nchildren - 1
+            for child in children:
+                heapq.heappush(heap, child)
+
+        leaves = sorted(leaf for leaf in leaves if -leaf[0] >= self.minfreq)
+        print("num of blocks : {} \nlevels : {}".format(len(leaves), np.bincount([leaf[1] for leaf in leaves],
+                                                                               minlength=self.max_level+1)))
+        return np.array([self.block_id(level, by, bx) for _, level, by, bx in leaves], dtype=np.int64)
+
+    def build_cell2vocab(self, chunk_size=1000000):
+        """
+        every cell takes the vocab of the block containing it,
+        or of the block whose center is the nearest when its block is not a vocab
+        """
+        assert self.built == True
+        table = np.full((self.numy, self.numx), -1, dtype=np.int32)
+        levels, ys, xs, sizes = self.block_of(self.hotcell)
+        for vocab, (y, x, size) in enumerate(zip(ys.tolist(), xs.tolist(), sizes.tolist()), self.vocab_start):
+            table[y:y+size, x:x+size] = vocab
+        self.cell2vocab = table.reshape(-1)
+
+        missing = np.flatnonzero(self.cell2vocab < 0)
+        for start in range(0, len(missing), chunk_size):
+            cell_ids = missing[start:start+chunk_size]
+            x, y = self.cell2coord(cell_ids)
+            _, indice = self.hotcell_kdtree.query(np.stack([x, y], axis=1), k=1) # indice of self.hotcell
+            self.cell2vocab[cell_ids] = indice[:, 0] + self.vocab_start
+        return self.cell2vocab
+
+    def uncovered_cells(self, cell_ids):
+        """
+        mask of the cells lying in none of the vocab blocks;
+        update_vocab appends such cells as level 0 blocks, which never overlap the existing ones
+        """
+        covered = np.zeros((self.numy, self.numx), dtype=bool)
+        _, ys, xs, sizes = self.block_of(self.hotcell)
+        for y, x, size in zip(ys.tolist(), xs.tolist(), sizes.tolist()):
+            covered[y:y+size, x:x+size] = True
+        return ~covered.reshape(-1)[np.asarray(cell_ids, dtype=np.int64)]
+
+    def vocab_offsets_normalized(self):
+        """
+        (vocab_size, 2) : block center offsets normalized by (numx, numy), 0 for the special vocabs
+        """
+        x, y = self.cell2coord(self.hotcell)
+        offsets = np.zeros((self.vocab_size, 2))
+        offsets[self.vocab_start:, 0] = ((x - self.minx) / self.xstep - 0.5) / self.numx
+        offsets[self.vocab_start:, 1] = ((y - self.miny) / self.ystep - 0.5) / self.numy
+        return offsets
+
+    def region_artifact_meta(self):
+        meta = super(QuadTreeRegion, self).region_artifact_meta()
+        meta["max_level"] = self.max_level
+        return meta
@@ -0,0 +1,84 @@
+"""
+Compressed size and random-read throughput of the subgraph files (A_subgraphs/*.h5)
+through TrajDataset.__getitem__, for a list of writer settings
+
+python benchmark_h5.py --src /data/dykim/porto/A_subgraphs --prefix train_traj \
+    --n_samples 1133657 --n_processors 36 --settings none gzip:4 lz4 blosc:5 --reads 20000
+
+each setting "codec[:level]" rewrites the subgraph files into --out/<setting>/ and reads
+--reads random trajectories; run on a cold page cache for disk-bound numbers
+"""
+import os
+import pathlib
+import argparse
+import timeit
+
+import h5py
+import numpy as np
+
+import tripstore
+
+parser = argparse.ArgumentParser(description='benchmark compression of subgraph files')
+parser.add_argument('--src', type=str, help='directory of the subgraph files')
+parser.add_argument('--prefix', default='train_traj', type=str, help='prefix of the subgraph files')
+parser.add_argument('--out', default='/tmp/benchmark_h5', type=str, help='directory of the rewritten files')
+parser.add_argument('--n_samples', default=1133657, type=int, help='n_samples of TrajDataset')
+parser.add_argument('--n_processors', default=36, type=int, help='n_processors of TrajDataset')
+parser.add_argument('--settings', nargs='+', default=['none', 'gzip:4', 'lz4', 'blosc:5'],
+                    help='codec[:level] to compare')
+parser.add_argument('--chunk', default=None, type=int, help='chunk length along the last axis')
+parser.add_argument('--reads', default=20000, type=int, help='number of random reads')
+parser.add_argument('--seed', default=0, type=int, help='seed of the random indices')
+
+
+def recompress(src_fname, dst_fname, h5opts):
+    with h5py.File(src_fname, "r") as src, h5py.File(dst_fname, "w") as dst:
+        def copy(name, obj):
+            if isinstance(obj, h5py.Dataset):
+                tripstore.h5_write(dst, name, obj[()], h5opts)
+        src.visititems(copy)
+
+
+def benchmark(setting, subgraph_fnames, opts):
+    codec, _, level = setting.partition(":")
+    h5opts = {"codec": codec, "level": int(level) if level else None, "chunk": opts.chunk}
+    out_dir = pathlib.PosixPath(opts.out)/setting.replace(":", "_")
+    os.makedirs(out_dir, exist_ok=True)
+
+    links, size = [], 0
+    for fname, start in subgraph_fnames:
+        recompress(pathlib.PosixPath(opts.src)/fname, out_dir/fname, h5opts)
+        size += os.path.getsize(out_dir/fname)
+        links.append((start, out_dir/fname))
+    index_fname = out_dir/"merged_index.h5"
+    tripstore.write_link_index(index_fname, links)
+
+    from dataloader import TrajDataset
+    dataset = TrajDataset(file_path=str(index_fname), n_samples=opts.n_samples,
+                          n_processors=opts.n_processors)
+    indices = np.random.RandomState(opts.seed).randint(0, opts.n_samples, opts.reads)
+    start_time = timeit.default_timer()
+    for index in indices:
+        dataset[int(index)]
+    elapsed = timeit.default_timer() - start_time
+    dataset.data.close()
+    return size, elapsed
+
+
+def main():
+    opts = parser.parse_args()
+    # exactly .h5 : .h5.tmp files are chunks left unfinished by create_trainval_edit.py
+    fnames = [fname for fname in os.listdir(opts.src) if fname.startswith(opts.prefix) and fname.endswith(".h5")]
+    # [(fname, start_num), ...] as in dataloader.py
+    subgraph_fnames = sorted([(fname, int(fname.split("_")[-2])) for fname in fnames], key=lambda x: x[1])
+
+    print("{:<12} {:>12} {:>14} {:>12}".format("setting", "size(MB)", "reads/s", "ms/read"))
+    for setting in opts.settings:
+        size, elapsed = benchmark(setting, subgraph_fnames, opts)
+        print("{:<12} {:>12.1f} {:>14.1f} {:>12.3f}".format(setting, size/2**20,
+                                                            opts.reads/elapsed,
+                                                            1000*elapsed/opts.reads))
+
+
+if __name__ == "__main__":
+    main()
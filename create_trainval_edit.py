@@ -3,6 +3,7 @@ import pandas as pd
 import pathlib
 
 import ast
+import os
 import sys
 import traceback
 import numpy as np
@@ -10,13 +11,13 @@ import timeit
 
 import torch
 import multiprocessing
-import ctypes
 from itertools import repeat 
 import data_utils as utils
+import tripstore
 
 from GraphRegion import GraphRegion
 from preprocessing import SpatialRegion
-from collections import defaultdict
+from collections import defaultdict, deque
 import argparse
 
 ######################################################################
@@ -31,9 +32,17 @@ parser.add_argument('--val', action='store_true',default=False,  help = 'val src
 parser.add_argument('--name', type=str, help='')
 parser.add_argument('--k_hop', default=1, type=int, help='hop size')
 parser.add_argument('--processors', default=20, type=int, help='num of processors')
+parser.add_argument('--chunk_trajs', default=1000, type=int, help='trajectories per work chunk (per output file)')
+parser.add_argument('--retries', default=2, type=int, help='retries of failed chunks')
+parser.add_argument('--chunk_timeout', default=1800, type=int, help='seconds after which a chunk without result is retried')
+parser.add_argument('--codec', default='none', type=str, choices=tripstore.CODECS,
+                    help='compression of the subgraph datasets (lz4/blosc need hdf5plugin)')
+parser.add_argument('--level', default=None, type=int, help='compression level')
+parser.add_argument('--chunk', default=None, type=int, help='chunk length along the last axis')
 
 global opts
 opts = parser.parse_args()
+h5opts = {"codec": opts.codec, "level": opts.level, "chunk": opts.chunk}
 
 ######################################################################
 
@@ -45,6 +54,24 @@ def str2seq(string):
     return np.array(vocabs)
 
 
+def load_seqs(path):
+    """
+    the token sequences at path : memory-mapped tripstore.TokenSeqStore when
+    path.tokens.npy exists (createTrainVal(output_format="binary") or tripstore.text2tokens),
+    the lines of the text file otherwise
+    """
+    if tripstore.TokenSeqStore.exists(path):
+        return tripstore.TokenSeqStore(path)
+    with open(path, "r") as f:
+        return f.readlines()
+
+
+def get_seq(src, num):
+    if isinstance(src, tripstore.TokenSeqStore):
+        return src[num].astype(np.int64) # UNK is already 0
+    return str2seq(src[num])
+
+
 data_dir = pathlib.PosixPath("data/")
 dset_name = "porto"
 
@@ -65,26 +92,76 @@ trips_vocab_path = ["train_unique.trg", "valid_unique.trg"]
 
 file_path = data_dir/"porto"/trips_path
 
-with open(data_dir/dset_name/trips_vocab_path[0], "r") as f:
-    train = f.readlines()
-
-with open(data_dir/dset_name/trips_vocab_path[1], "r") as f:
-    val = f.readlines()
-
-src = train if opts.train else val
+src = load_seqs(data_dir/dset_name/trips_vocab_path[0 if opts.train else 1])
 
 k_paths = ["entire_porto_sparseadj1hop.pt", "entire_porto_sparseadj1_2hop.pt", 
            "entire_porto_sparseadj1_3hop.pt", "entire_porto_sparseadj1_4hop.pt"]
 k_fname = k_paths[opts.k_hop-1]
 k_adjmat =torch.load(data_dir/graphregion.dataset_name/"region_info"/k_fname)
-k_adjmat= k_adjmat.to_dense()
+# CSR/CSC index of the k-hop graph, shared with the forked workers : memory ~ #edges instead of V^2
+graphregion.build_neighbor_index(adj=k_adjmat)
+del k_adjmat
+
+
+def khop_subgraph(trip_unique):
+    """
+    @param trip_unique : sorted nodes (vocab-vocab_start) of a trajectory
+    return conn_nodes : sorted trajectory nodes and the nodes with a k-hop edge to one of them,
+           sub_adj : (2,E) edges of the k-hop graph between conn_nodes, as local indices in row-major order
+    """
+    in_nodes, _ = graphregion.gather_neighbors(trip_unique, "in")
+    conn_nodes = np.union1d(in_nodes, trip_unique).astype(np.int64)
+    
+    cols, offsets = graphregion.gather_neighbors(conn_nodes, "out")
+    rows = np.repeat(np.arange(len(conn_nodes)), np.diff(offsets))
+    pos = np.searchsorted(conn_nodes, cols)
+    inside = pos < len(conn_nodes)
+    inside[inside] = conn_nodes[pos[inside]] == cols[inside]
+    sub_adj = np.stack([rows[inside], pos[inside]], axis=0)
+    return conn_nodes, sub_adj
+
+def trajectory_edges(conn_nodes, sub_adj, traj_nodes, trip):
+    """
+    edges of the trajectory movements in the subgraph, with integer edge keys src*N+dst (N = len(conn_nodes))
+    looked up by np.searchsorted in the keys of sub_adj, which are sorted (row-major)
+    
+    @param conn_nodes : (N,) vocabs of the subgraph nodes, ascending, UNK (0) last
+    @param sub_adj : (2,E) local edges in row-major order
+    @param traj_nodes : consecutive unique vocabs of the trajectory ; trip : its vocabs
+    return sub_adj : (2,E+#unk) with the movements missing from the graph appended in order of first appearance,
+           traj_idx : (len(traj_nodes)-1,) edge of every movement, trip_index : (len(trip),) node index of every point,
+           #unk movements appended
+    """
+    N = len(conn_nodes)
+    def node_index(vocabs):
+        idx = np.where(vocabs == 0, N-1, np.searchsorted(conn_nodes[:-1], vocabs))
+        missing = conn_nodes[np.minimum(idx, N-1)] != vocabs
+        if missing.any():
+            raise KeyError(vocabs[missing][0])
+        return idx
+    
+    traj_nodes_idx = node_index(traj_nodes)
+    move_keys = traj_nodes_idx[:-1].astype(np.int64)*N + traj_nodes_idx[1:]
+    edge_keys = sub_adj[0].astype(np.int64)*N + sub_adj[1]
+    E = len(edge_keys)
+    pos = np.searchsorted(edge_keys, move_keys)
+    found = pos < E
+    found[found] = edge_keys[pos[found]] == move_keys[found]
+    traj_idx = np.where(found, pos, -1)
+    
+    unk_keys = move_keys[~found]
+    n_unk = 0
+    if len(unk_keys) > 0:
+        uniq, first = np.unique(unk_keys, return_index=True)
+        order = np.argsort(first) # uniq[order] : first appearance order
+        n_unk = len(uniq)
+        rank = np.empty(len(uniq), dtype=np.int64)
+        rank[order] = np.arange(len(uniq))
+        unk_movement = np.stack([uniq[order] // N, uniq[order] % N]).astype(sub_adj.dtype) # (2, unk_move)
+        sub_adj = np.concatenate((sub_adj, unk_movement), axis=1) # (2, len+unk_move)
+        traj_idx[~found] = E + rank[np.searchsorted(uniq, unk_keys)]
+    return sub_adj, traj_idx, node_index(trip).astype(np.int32), n_unk
 
-shared_array_base = multiprocessing.Array(ctypes.c_int16,
-                                        k_adjmat.size(0)*k_adjmat.size(1))
-shared_array = np.ctypeslib.as_array(shared_array_base.get_obj())
-shared_array = shared_array.reshape(k_adjmat.size(0),  k_adjmat.size(1))
-shared_array[:] = k_adjmat.numpy()[:]
-# print('shared_array dtype: ', shared_array.dtype)
 
 def vocab2offset_normalized(vocab):
     cell_id = graphregion.vocab2hotcell[vocab]
@@ -96,35 +173,141 @@ def vocab2offset_normalized(vocab):
     xoffset = xoffset/graphregion.numx
     return (xoffset, yoffset)
 
-graphregion.vocab2offset_normalized = {vocab:vocab2offset_normalized(vocab)
-                                       for vocab in range(graphregion.vocab_start,graphregion.vocab_size)}
+# same values as vocab2offset_normalized, computed from the hotcell array at once
+graphregion.vocab2offset_normalized = {vocab:tuple(offset) for vocab, offset in 
+                                       enumerate(graphregion.vocab_offsets_normalized().tolist())
+                                       if vocab >= graphregion.vocab_start}
             
 
-def create_train_val(src, processors, path, shared_array=shared_array):
-    
-    pool = multiprocessing.Pool(processes=processors)
-    batch_n = processors
-    batch_size = len(src)//batch_n
-    batch_number = 0
+def subgraph_fname(path, s, e):
+    return path/"{}_{}_{}_{}.h5".format("train" if opts.train else "val", opts.name, s, e)
+
+
+def subgraph_tmp_fname(path, s, e, attempt):
+    # one name per attempt : a retry never writes into the file of an attempt still running
+    fname = subgraph_fname(path, s, e)
+    return fname.with_name("{}.{}.tmp".format(fname.name, attempt))
+
+
+_chunk_starts = None
+
+def _init_chunk_worker(starts):
+    global _chunk_starts
+    _chunk_starts = starts
+
+
+def _subgraph_chunk(args):
+    """
+    worker of create_train_val : reports (s, e, attempt, pid) on _chunk_starts when it starts the chunk,
+    never raises, so that a failed chunk is reported with its range
+    return (s, e, attempt, fname or None, error message or None, seconds)
+    """
+    s, e, path, attempt = args
+    _chunk_starts.put((s, e, attempt, os.getpid()))
+    start_time = timeit.default_timer()
+    try:
+        fname = create_train_val_batch(s, e, path, attempt)
+        return s, e, attempt, fname, None, timeit.default_timer() - start_time
+    except Exception as ex:
+        traceback.print_exc()
+        tmp_fname = subgraph_tmp_fname(path, s, e, attempt)
+        if os.path.exists(tmp_fname):
+            os.remove(tmp_fname)
+        return s, e, attempt, None, "{}: {}".format(type(ex).__name__, ex), timeit.default_timer() - start_time
+
+
+def create_train_val(src, processors, path, chunk_size=1000, retries=2, chunk_timeout=1800):
+    """
+    create the subgraphs of src in chunks of chunk_size trajectories, a new chunk being submitted
+    whenever one finishes so that all workers stay busy until the end whatever the trajectory lengths;
+    every chunk is written to its own s_e file, chunks whose file already exists are skipped,
+    failed chunks are retried up to retries times, then the link index of the files is written
+
+    @param chunk_size : trajectories per chunk (per file)
+    @param chunk_timeout : seconds after a worker started a chunk without result after which the chunk 
+                           counts as failed (the worker hangs) ; a chunk whose worker died 
+                           (e.g. killed out of memory) fails as soon as the death is seen
+    raise RuntimeError without writing the link index when chunks are still failing after the retries
+    return the link index file name
+    """
+    os.makedirs(path, exist_ok=True)
+    chunks = [(s, min(s+chunk_size, len(src))) for s in range(0, len(src), chunk_size)]
+    done = {(s, e):subgraph_fname(path, s, e) for s, e in chunks if os.path.exists(subgraph_fname(path, s, e))}
+    todo = deque((s, e) for s, e in chunks if (s, e) not in done)
     print("Start creating subgraphs")
-    print("Total batch: ", batch_n)
-    print("Batch size: ", batch_size)
-    
-    for i in range(len(src)):
-        if (i!=0) and (i%batch_size==0):
-            if batch_number == batch_n-1:
-                print("Distributing ", (batch_size*batch_number, len(src))) 
-                pool.apply_async(create_train_val_batch, (batch_size*batch_number, None, path))
-            else : 
-                print("Distributing ", (batch_size*batch_number, i)) 
-                pool.apply_async(create_train_val_batch, (batch_size*batch_number, i, path))
-            batch_number += 1
-            
-    pool.close()
-    pool.join()
+    print("Total chunks: {} ({} already done)".format(len(chunks), len(done)))
+    print("Chunk size: ", chunk_size)
+
+    total = sum(e-s for s, e in todo)
+    n_trajs = 0
+    attempts = defaultdict(int)
+    running = {} # (s, e) -> (AsyncResult, attempt) ; at most processors chunks
+    started = {} # (s, e, attempt) -> (pid, time the start was seen)
+    failed = []
+    abandoned = False
+    start_time = timeit.default_timer()
+    starts = multiprocessing.SimpleQueue() # put() writes at once, before a worker can die
+    pool = multiprocessing.Pool(processes=processors, initializer=_init_chunk_worker, initargs=(starts,))
+    try:
+        while todo or running:
+            while todo and len(running) < processors:
+                s, e = todo.popleft()
+                running[(s, e)] = (pool.apply_async(_subgraph_chunk, ((s, e, path, attempts[(s, e)]),)),
+                                   attempts[(s, e)])
+            next(iter(running.values()))[0].wait(1)
+            while not starts.empty():
+                s, e, attempt, pid = starts.get()
+                started[(s, e, attempt)] = (pid, timeit.default_timer())
+            alive = {p.pid for p in multiprocessing.active_children()}
+            for (s, e), (result, attempt) in list(running.items()):
+                pid, since = started.get((s, e, attempt), (None, None))
+                if result.ready():
+                    _, _, _, fname, error, seconds = result.get()
+                elif pid is not None and pid not in alive:
+                    error = "worker {} died".format(pid)
+                    abandoned = True
+                elif since is not None and timeit.default_timer() - since > chunk_timeout:
+                    error = "no result {}s after its start, worker {} hangs".format(chunk_timeout, pid)
+                    abandoned = True
+                else:
+                    continue
+                del running[(s, e)]
+                started.pop((s, e, attempt), None)
+                if error is not None:
+                    attempts[(s, e)] += 1
+                    print("Chunk ({} ~ {}) failed : {}".format(s, e, error))
+                    if attempts[(s, e)] <= retries:
+                        print("Retrying chunk ({} ~ {}) ({}/{})".format(s, e, attempts[(s, e)], retries))
+                        todo.append((s, e))
+                    else:
+                        failed.append((s, e))
+                    continue
+                done[(s, e)] = fname
+                n_trajs += e-s
+                elapsed = timeit.default_timer() - start_time
+                rate = n_trajs / elapsed
+                print("{}/{} chunks, {}/{} trajs ({:.2f}%), {:.1f} trajs/s, chunk {:.1f}s, eta {:.0f}s".format(
+                    len(done), len(chunks), n_trajs, total, 100*n_trajs/max(total, 1), rate, seconds,
+                    (total-n_trajs)/rate))
+    finally:
+        if abandoned:
+            # the task of a dead worker never completes : join() would wait for it forever,
+            # and no submission is queued behind the running chunks
+            pool.terminate()
+        else:
+            pool.close()
+            pool.join()
+
+    if len(failed) > 0:
+        raise RuntimeError("{} chunks failed after {} retries, link index not written : {}".format(
+            len(failed), retries, sorted(failed)))
+    index_fname = path/"merged_{}_{}_index.h5".format("train" if opts.train else "val", opts.name)
+    tripstore.write_link_index(index_fname, [(s, fname) for (s, e), fname in done.items()])
+    print("Link index of {} files written to {}".format(len(done), index_fname))
+    return index_fname
     
 
-def create_train_val_batch(s,e, path, shared_array=shared_array):# d_all_nodes, d_traj_nodes
+def create_train_val_batch(s,e, path, attempt=0):# d_all_nodes, d_traj_nodes
     """
     create sub adjacency matrix centered on each trajectory
 
@@ -133,25 +316,21 @@ def create_train_val_batch(s,e, path, shared_array=shared_array):# d_all_nodes,
     @param num : index
 
     ex) create_train_val(f, src, num)
+    return the file name of the chunk
     """
 #     print(s,e,"\n")
     if e is None:
         e = len(src)
     
-    adj_size = graphregion.vocab_size-graphregion.vocab_start
-    
     # path is set as a global var
     # path = data_dir/graphregion.dataset_name/"train_val"/A1/
-    # s_e.h5
-    print("Creating {} file \n".format(str(path/"{}_{}_{}_{}.h5".format("train" if opts.train else "val",
-                                                                        opts.name,
-                                                                     s,e))))
-    with h5py.File(path/"{}_{}_{}_{}.h5".format("train" if opts.train else "val",opts.name,s,e),"w") as f:
+    # s_e.h5, written under a temporary name so that an interrupted chunk is redone
+    fname = subgraph_fname(path, s, e)
+    tmp_fname = subgraph_tmp_fname(path, s, e, attempt)
+    with h5py.File(tmp_fname,"w") as f:
         for num in range(s,e):
-            seq = src[num]
-            
             try:
-                trip = str2seq(seq) # UNK -> 0
+                trip = get_seq(src, num) # UNK -> 0
                 #(n_of_unks) : # UNK -> -4
                 
                 
@@ -159,7 +338,7 @@ def create_train_val_batch(s,e, path, shared_array=shared_array):# d_all_nodes,
                 # UNK -> -4
                 # consecutive unique traj_nodes
 #                 traj_nodes = trip[trip!=0] # filter out UNK
-                traj_nodes = np.array([trip[i] for i in range(len(trip)-1) if trip[i] != trip[i+1]] + [trip[-1]])
+                traj_nodes = trip[np.append(trip[:-1] != trip[1:], True)]
                 if (len(traj_nodes) == 1) or (len(traj_nodes[traj_nodes!=0]) == 0) : 
                     print('traj of which len = 1 or full of UNK filtered out')
                     f["{}/edge_index".format(num)] = [-1]
@@ -176,14 +355,8 @@ def create_train_val_batch(s,e, path, shared_array=shared_array):# d_all_nodes,
                 trip_unique -= graphregion.vocab_start
                 trip_unique = trip_unique[trip_unique>=0] #filter out UNK
                 ###############################################################                                     # compute conn_nodes with the trajectory
-                conn_nodes = shared_array[:, trip_unique] # (#vocabs, len(trip))
-                conn_nodes = np.sum(conn_nodes, axis=1) #(#vocabs,)
-                conn_nodes[trip_unique] = 1
-                conn_nodes = np.arange(adj_size)[conn_nodes != 0]
-
                 # compute edge_index
-                sub_adj = shared_array[conn_nodes,:][:,conn_nodes]
-                sub_adj = np.transpose(np.stack(sub_adj.nonzero(), axis=1)) # (2,E)
+                conn_nodes, sub_adj = khop_subgraph(trip_unique) # (2,E)
 #                 print('sub_adj dtype: ', sub_adj.dtype)
 #                 print('sub_adj max: ', sub_adj.max())
                 # memory manage
@@ -195,34 +368,9 @@ def create_train_val_batch(s,e, path, shared_array=shared_array):# d_all_nodes,
 #                 print('sub_adj max: ', sub_adj.max())
                 # compute edge_attr
                 # consecutive unique traj_nodes : 
-                conn_nodes2idx = {node:i for i,node in enumerate(conn_nodes)}
-                edge_index2idx = {str(sub_adj[:,edge_i]):edge_i for edge_i in range(sub_adj.shape[1])}
-                # vocab to idx
-                conn_nodes_idx = [conn_nodes2idx[node] for node in conn_nodes]
-                traj_nodes_idx = [conn_nodes2idx[node] for node in traj_nodes] 
-                # traj_point_movement to edge_idx
-                traj_idx_ = np.array(list(zip(traj_nodes_idx[:-1], traj_nodes_idx[1:])))
-                traj_idx = np.array([edge_index2idx.get(str(edge),-1) for edge in traj_idx_])
-
-                unk_traj_index = [i for i,idx in enumerate(traj_idx) if idx== -1]
-                if len(unk_traj_index) > 0 :
+                sub_adj, traj_idx, trip_index, n_unk = trajectory_edges(conn_nodes, sub_adj, traj_nodes, trip)
+                if n_unk > 0:
                     print("inserting unk movement")
-                    unk_movement = np.unique(traj_idx_[unk_traj_index], axis=0, return_index=True)[1]
-                    unk_movement = np.array([traj_idx_[unk_traj_index][ind] for ind in sorted(unk_movement)]).transpose() # (2, unk_move)
-                    # add to adj_matrix
-                    sub_adj=np.concatenate((sub_adj,unk_movement), axis=1) # (2, len+unk_move)
-#                     print('added unk_movement: ', unk_movement)
-#                     print('conn nodes size: ', len(conn_nodes_idx))
-                    
-                    for col_i in range(unk_movement.shape[1]): #(2, unk_move)
-                        
-                        edge_index2idx[str(unk_movement[:,col_i])] = len(edge_index2idx)
-                        
-                    traj_idx[unk_traj_index] = [edge_index2idx[str(unk_edge)] for unk_edge in traj_idx_[unk_traj_index]]
-#                     print(traj_idx_[unk_traj_index], '->', traj_idx[unk_traj_index])
-#                     print("sub adjmatrix size: ", sub_adj.shape)
-                    print("len of : unk_movement",len([i for i,idx in enumerate(traj_idx) if idx== -1]))
-#                     print("done \n")
                 
 #                 print('sub_adj max: ', sub_adj.max())
                 # edge attr by order
@@ -237,38 +385,37 @@ def create_train_val_batch(s,e, path, shared_array=shared_array):# d_all_nodes,
 #                 print("trip_consecutive_unique.shape: ", len(traj_nodes), "max(edge_attr): ", np.max(edge_attr))
 #                 print("#outofconns: ", np.setdiff1d(trip, conn_nodes))
 
-                trip_index = [conn_nodes2idx[node] for node in trip]
-                trip_index = np.array(trip_index).astype(np.int32)
 #                 print(num, "trip: ", trip, trip.shape, "trip_index: ", trip_index, trip_index.shape)
                 # int32 float32 int32 int32
-                f["{}/edge_index".format(num)] = sub_adj # (2,E)
-                f["{}/edge_attr".format(num)] = traj_idx.astype(np.int32)
+                tripstore.h5_write(f, "{}/edge_index".format(num), sub_adj, h5opts) # (2,E)
+                tripstore.h5_write(f, "{}/edge_attr".format(num), traj_idx.astype(np.int32), h5opts)
                 # to be data.x
-                f["{}/all_nodes".format(num)] = conn_nodes #including trip vocabs : np.int16 : vocab 기준으로 회복
-                f["{}/traj_nodes".format(num)] = trip # UNK->0 : 
-                f["{}/traj_index".format(num)] = trip_index # UNK->0 : 
+                tripstore.h5_write(f, "{}/all_nodes".format(num), conn_nodes, h5opts) #including trip vocabs : np.int16 : vocab 기준으로 회복
+                tripstore.h5_write(f, "{}/traj_nodes".format(num), trip, h5opts) # UNK->0 : 
+                tripstore.h5_write(f, "{}/traj_index".format(num), trip_index, h5opts) # UNK->0 : 
                 
 #                 print('sub_adj:',sub_adj.astype(np.uint8),
 #                       'edge_attr:',
 #                      edge_attr.astype(np.int16),
 #                      'conn_nodes:', conn_nodes,
 #                      'trip:', trip)
-                
-                if (num-s) % 3000 == 2999 :
-                    print("Batch({} ~ {}) processing {}/{}({:.2f}%)".format(s,e,(num-s+1),(e-s),
-                                                                        (num-s+1)/(e-s)))
 
-            except Exception as e: 
-                print(e)
+            except Exception as ex: 
+                print(ex)
                 print("trip ", trip)
-                print("traj_nodes_idx ", traj_nodes_idx)
                 print("error")
                 traceback.print_exc()
-                f["{}/error".format(num)] = str(e)
-                f["{}/edge_index".format(num)] = None
-                f["{}/all_nodes".format(num)] = None
-                f["{}/traj_nodes".format(num)] = None
-                f["{}/edge_attr".format(num)] = None
+                # same -1 markers as the filtered trajectories, replacing what was written before the error
+                if str(num) in f:
+                    del f[str(num)]
+                f["{}/error".format(num)] = str(ex)
+                f["{}/edge_index".format(num)] = [-1]
+                f["{}/all_nodes".format(num)] = [-1]
+                f["{}/traj_nodes".format(num)] = [-1]
+                f["{}/edge_attr".format(num)] = [-1]
+                f["{}/traj_index".format(num)] = [-1]
+    os.replace(tmp_fname, fname)
+    return fname
 
 # in my folder
 # subgraphs_dirs = ["A1","A2","A3","A4"]
@@ -278,6 +425,6 @@ subgraph_dir = pathlib.PosixPath("/data/dykim")
 path = subgraph_dir/graphregion.dataset_name/"A_subgraphs"
 
 create_train_val(src, processors=opts.processors,
-                 path=path, 
-                 shared_array=shared_array)
+                 path=path, chunk_size=opts.chunk_trajs, retries=opts.retries,
+                 chunk_timeout=opts.chunk_timeout)
 
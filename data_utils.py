@@ -2,7 +2,13 @@
 import pandas as pd
 import numpy as np
 import h5py
-import random 
+import multiprocessing
+import os
+import json
+import shutil
+from collections import deque
+
+import tripstore
 #%%
 def porto2h5(filepath, limit=None, fname=None, is_first=True):
     log_f = str(fname).split("/")[-1].split(".")[0]
@@ -46,88 +52,417 @@ def porto2h5(filepath, limit=None, fname=None, is_first=True):
         log.close()
         print("Incompleted trip: {}\nSaved {} trips\nZerolenTrip: {} trips.".format(num_incompleted, num, num_zerolen))
         
+# %% streaming ingestion of the porto csv
+_POLYLINE_BRACKETS = str.maketrans("[]", "  ")
+
+def parse_polyline(polyline):
+    """
+    parsing a POLYLINE string "[[lon,lat],...]" without eval
+    return (len, 2) nd.array, or None if the polyline is incomplete
+    """
+    if not isinstance(polyline, str):
+        return None
+    polyline = polyline.strip()
+    if not (polyline.startswith("[") and polyline.endswith("]")):
+        return None
+    body = polyline.translate(_POLYLINE_BRACKETS).strip()
+    if not body:
+        return np.empty((0, 2))
+    try:
+        coords = np.array(body.split(","), dtype=np.float64)
+    except ValueError:
+        return None
+    npoints = len(coords) // 2
+    if (len(coords) % 2 != 0) or \
+    not (polyline.count("[") == polyline.count("]") == npoints + 1):
+        return None
+    return coords.reshape(-1, 2)
+
+
+def _parse_polyline_chunk(args):
+    chunk_i, nums, start_times, polylines = args
+    return chunk_i, nums, start_times, [parse_polyline(polyline) for polyline in polylines]
+
+
+def porto_tripnums(filepath, limit=None):
+    """
+    trip number of every csv row following the ordering of porto2h5
+    (MISSING_DATA filtered, df.loc[:limit,], sorted by TIMESTAMP)
+    return tripnums : (#rows,) where 0 means the row is not ingested, timestamps : (#rows,)
+    """
+    df = pd.read_csv(filepath, usecols=["TIMESTAMP", "MISSING_DATA"])
+    tripnums = np.zeros(len(df), dtype=np.int64)
+    timestamps = df.TIMESTAMP.values.astype(np.int64)
+    df = df[df.MISSING_DATA == False]
+    if limit:
+        df = df.loc[:limit,]
+    df.sort_values("TIMESTAMP", inplace = True)
+    tripnums[df.index.values] = np.arange(1, len(df)+1)
+    return tripnums, timestamps
+
+
+def iter_porto_chunks(filepath, limit=None, chunksize=100000, processes=None, skip_chunks=()):
+    """
+    streaming the POLYLINE column in chunks of csv rows, parsed over a process pool
+    yield (chunk_i, nums, start_times, trips) in csv order
+    trips[i] is (len, 2) nd.array or None(incomplete), start_times[i] its TIMESTAMP
+    
+    @param processes : None uses all cores, 1 parses in the calling process
+    @param skip_chunks : chunk indices that are read but neither parsed nor yielded
+    """
+    tripnums, timestamps = porto_tripnums(filepath, limit)
+    skip_chunks = set(skip_chunks)
+    
+    def jobs():
+        reader = pd.read_csv(filepath, usecols=["POLYLINE"], chunksize=chunksize)
+        for chunk_i, chunk in enumerate(reader):
+            if chunk_i in skip_chunks: continue
+            nums = tripnums[chunk.index.values]
+            keep = nums > 0
+            yield chunk_i, nums[keep], timestamps[chunk.index.values][keep], chunk.POLYLINE.values[keep]
+    
+    if processes == 1:
+        for job in jobs():
+            yield _parse_polyline_chunk(job)
+        return
+    
+    # bounded window of in-flight chunks so that the csv is never held in RAM
+    pool = multiprocessing.Pool(processes=processes)
+    window = 2 * (processes or multiprocessing.cpu_count())
+    pending = deque()
+    try:
+        for job in jobs():
+            pending.append(pool.apply_async(_parse_polyline_chunk, (job,)))
+            if len(pending) >= window:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        # on an error in the consumer, let the submitted chunks finish before shutting the pool down :
+        # terminate() with submissions in flight can deadlock in the task handler
+        for result in pending:
+            result.wait()
+        pool.close()
+        pool.join()
+
+
+def load_manifest(path, params):
+    """
+    progress manifest {"params": params, "chunks": {chunk_i: info}} of a resumable job
+    a manifest recorded with different params is discarded
+    """
+    params = json.loads(json.dumps(params))
+    if os.path.exists(path):
+        with open(path, "r") as f:
+            manifest = json.load(f)
+        if manifest.get("params") == params:
+            return manifest
+    return {"params": params, "chunks": {}}
+
+
+def save_manifest(path, manifest):
+    # write-then-rename so that a crash never leaves a truncated manifest
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f)
+    os.replace(path + ".tmp", path)
+
+
+def porto2parts(filepath, limit=None, parts_dir=None, chunksize=100000, processes=None,
+                resume=True, log=None):
+    """
+    ingest the csv chunk by chunk into ragged part files parts_dir/part_{chunk_i}.h5
+    completed chunks are recorded in parts_dir/manifest.json and skipped on a rerun
+    
+    return part_fnames in chunk order, (num, num_incompleted, num_zerolen)
+    """
+    os.makedirs(parts_dir, exist_ok=True)
+    manifest_path = os.path.join(parts_dir, "manifest.json")
+    params = {"filepath": str(filepath), "limit": limit, "chunksize": chunksize}
+    manifest = load_manifest(manifest_path, params) if resume else {"params": params, "chunks": {}}
+    if manifest["chunks"]:
+        print("Resuming: {} chunks already ingested".format(len(manifest["chunks"])))
+    
+    done = [int(chunk_i) for chunk_i in manifest["chunks"]]
+    for chunk_i, nums, start_times, trips in iter_porto_chunks(filepath, limit=limit, chunksize=chunksize,
+                                                               processes=processes, skip_chunks=done):
+        num, num_incompleted, num_zerolen = 0, 0, 0
+        tripids, valid_trips, valid_starts = [], [], []
+        for trip_num, start_time, trip in zip(nums, start_times, trips):
+            num += 1
+            if trip is None :
+                num_incompleted += 1
+                continue
+            if len(trip) == 0 :
+                num_zerolen += 1
+                continue
+            tripids.append(trip_num)
+            valid_trips.append(trip.transpose())
+            valid_starts.append(start_time)
+        
+        # porto is sampled every 15 s, so only the start time of each trip is kept
+        part_name = "part_{:05d}.h5".format(chunk_i)
+        tripstore.write_ragged(os.path.join(parts_dir, part_name), tripids, valid_trips,
+                               start_time=valid_starts, interval=15)
+        manifest["chunks"][str(chunk_i)] = {"part": part_name, "num": num,
+                                            "incompleted": num_incompleted, "zerolen": num_zerolen}
+        save_manifest(manifest_path, manifest)
+        
+        if log is not None:
+            log.write("Scanned chunk {}\n".format(chunk_i))
+        print("Scanned chunk {}\n".format(chunk_i))
+    
+    chunks = [manifest["chunks"][chunk_i] for chunk_i in sorted(manifest["chunks"], key=int)]
+    counts = tuple(sum(chunk[key] for chunk in chunks) for key in ["num", "incompleted", "zerolen"])
+    return [os.path.join(parts_dir, chunk["part"]) for chunk in chunks], counts
+
+
+def porto2h5_stream(filepath, limit=None, fname=None, chunksize=100000, processes=None, resume=True,
+                    h5opts=None):
+    """
+    chunked, eval-free version of porto2h5 with the same trip numbering and layout
+    progress is kept in fname.parts/, so a rerun after a crash only ingests missing chunks
+    @param h5opts : {"codec": "gzip"|"lz4"|"blosc", "level":.., "chunk":..}, see tripstore.h5_dataset_kwargs
+    
+    porto2h5_stream("data/porto/train.csv", fname="data/porto/preprocessed_entire_porto.h5")
+    """
+    log_f = str(fname).split("/")[-1].split(".")[0]
+    log = open("log/{}.txt".format(log_f), "w")
+    
+    parts_dir = "{}.parts".format(fname)
+    part_fnames, (num, num_incompleted, num_zerolen) = porto2parts(filepath, limit=limit,
+                                                                   parts_dir=parts_dir,
+                                                                   chunksize=chunksize,
+                                                                   processes=processes,
+                                                                   resume=resume, log=log)
+    # written from the parts in chunk order, so the output does not depend on interruptions
+    with h5py.File(fname,"w") as f:
+        for part_fname in part_fnames:
+            with tripstore.RaggedTripStore(part_fname) as part:
+                for trip_num, trip in part:
+                    tripstore.h5_write(f, "/trips/{}".format(trip_num), trip, h5opts)
+                    tripstore.h5_write(f, "/timestamps/{}".format(trip_num),
+                                       part.get_timestamps(trip_num, absolute=False), h5opts)
+    shutil.rmtree(parts_dir)
+    
+    log.write("Incompleted trip: {}\nSaved {} trips\nZerolenTrip: {} trips.".format(num_incompleted, num, num_zerolen))
+    log.close()
+    print("Incompleted trip: {}\nSaved {} trips\nZerolenTrip: {} trips.".format(num_incompleted, num, num_zerolen))
+
+
+def porto2ragged(filepath, limit=None, fname=None, chunksize=100000, processes=None, resume=True,
+                 h5opts=None):
+    """
+    streaming ingestion into the consolidated layout of tripstore.py
+    (one points array, one offsets array and one trip-id array)
+    each csv chunk is written to fname.parts/ sorted by trip number, then merged;
+    a rerun after a crash only ingests the chunks missing from fname.parts/manifest.json
+    @param h5opts : {"codec": "gzip"|"lz4"|"blosc", "level":.., "chunk":..}, see tripstore.h5_dataset_kwargs
+    
+    porto2ragged("data/porto/train.csv", fname="data/porto/preprocessed_entire_porto_ragged.h5")
+    """
+    log_f = str(fname).split("/")[-1].split(".")[0]
+    log = open("log/{}.txt".format(log_f), "w")
+    
+    parts_dir = "{}.parts".format(fname)
+    part_fnames, (num, num_incompleted, num_zerolen) = porto2parts(filepath, limit=limit,
+                                                                   parts_dir=parts_dir,
+                                                                   chunksize=chunksize,
+                                                                   processes=processes,
+                                                                   resume=resume, log=log)
+    tripstore.merge_ragged(part_fnames, fname, h5opts=h5opts)
+    shutil.rmtree(parts_dir)
+    
+    log.write("Incompleted trip: {}\nSaved {} trips\nZerolenTrip: {} trips.".format(num_incompleted, num, num_zerolen))
+    log.close()
+    print("Incompleted trip: {}\nSaved {} trips\nZerolenTrip: {} trips.".format(num_incompleted, num, num_zerolen))
+
 # %% create a sequece of trjaectory (tripid, timestamp, lon, lat)
+def explode_polylines(df):
+    """
+    exploding POLYLINE of every row into one (tripid, timestamps, lon, lat) table
+    zero-length and incomplete trips are dropped
+    
+    @param df : pd.DataFrame with TRIP_ID, TIMESTAMP, POLYLINE
+    """
+    gps = [parse_polyline(polyline) for polyline in df.POLYLINE.values]
+    valid = np.array([(trip is not None) and (len(trip) > 0) for trip in gps], dtype=bool)
+    gps = [trip for trip, is_valid in zip(gps, valid) if is_valid]
+    
+    lengths = np.array([len(trip) for trip in gps], dtype=np.int64)
+    points = np.concatenate(gps) if gps else np.empty((0, 2))
+    # position of every point within its trip
+    steps = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    
+    return pd.DataFrame({
+        'tripid' : np.repeat(df.TRIP_ID.values[valid], lengths),
+        'timestamps' : np.repeat(df.TIMESTAMP.values[valid], lengths) + steps*15,
+        'lon' : points[:,0],
+        'lat' : points[:,1]
+    })
+
+
 def porto2standardcsv(filepath, limit=None, fname=None):
     df = pd.read_csv(filepath)
     df = df[df.MISSING_DATA == False]
     if limit:
         df = df.loc[:limit,]
-    trips = pd.DataFrame(columns = {"tripid","timestamps","lon","lat"})
-    for i, row in df.iterrows():
-        gps = np.array(eval(row.POLYLINE))
-        tripLength = len(gps)
-        if tripLength == 0 : continue
-        trip = pd.DataFrame({
-            'tripid' : np.repeat(row.TRIP_ID,tripLength),
-            'timestamps' : np.repeat(row.TIMESTAMP,tripLength) + np.arange(0,tripLength)*15,
-            'lon' : gps[:,0],
-            'lat' : gps[:,1]
-        })
-        trips = trips.append(trip,ignore_index=True)
-        if i % 1000 == 0 : print("Processed %d rows." % (i))
+    trips = explode_polylines(df)
+    print("Processed %d rows." % (len(df)))
     if fname:
         trips.to_csv(fname,index=False)
     else : 
         trips.to_csv("/data/porto/preprocessed_porto.csv",index=False)
     
     return trips
+
+
+def porto2parquet(filepath, limit=None, fname=None, chunksize=100000, partition_seconds=86400):
+    """
+    columnar version of porto2standardcsv : (tripid, timestamps, lon, lat) written as
+    a parquet dataset partitioned by time_bucket = timestamps // partition_seconds
+    
+    porto2parquet("data/porto/train.csv", fname="data/porto/preprocessed_porto.parquet")
+    """
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    
+    fname = fname or "/data/porto/preprocessed_porto.parquet"
+    if os.path.exists(fname):
+        shutil.rmtree(fname)
+    
+    reader = pd.read_csv(filepath, usecols=["TRIP_ID", "TIMESTAMP", "MISSING_DATA", "POLYLINE"],
+                         chunksize=chunksize)
+    num_rows = 0
+    for chunk_i, df in enumerate(reader):
+        if limit:
+            if df.index[0] > limit: break
+            df = df.loc[:limit,]
+        df = df[df.MISSING_DATA == False]
+        trips = explode_polylines(df)
+        trips["time_bucket"] = trips.timestamps // partition_seconds
+        
+        ds.write_dataset(pa.Table.from_pandas(trips, preserve_index=False), fname,
+                         format="parquet",
+                         partitioning=ds.partitioning(pa.schema([("time_bucket", pa.int64())]), flavor="hive"),
+                         basename_template="chunk{:05d}-{{i}}.parquet".format(chunk_i),
+                         existing_data_behavior="overwrite_or_ignore")
+        num_rows += len(df)
+        print("Processed %d rows." % (num_rows))
+
+
+def read_standardparquet(fname, tripids=None, time_range=None, columns=None,
+                         partition_seconds=86400):
+    """
+    memory-mapped read of a porto2parquet dataset, filtered without parsing csv
+    
+    @param tripids : iterable of TRIP_ID to keep
+    @param time_range : (start, end) keeps start <= timestamps < end
+    return pd.DataFrame sorted by (tripid, timestamps)
+    """
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    from pyarrow import fs
+    
+    dataset = ds.dataset(fname, format="parquet",
+                         partitioning=ds.partitioning(pa.schema([("time_bucket", pa.int64())]), flavor="hive"),
+                         filesystem=fs.LocalFileSystem(use_mmap=True))
+    condition = None
+    if tripids is not None:
+        condition = ds.field("tripid").isin(list(tripids))
+    if time_range is not None:
+        start, end = time_range
+        in_range = (ds.field("time_bucket") >= start // partition_seconds) & \
+                   (ds.field("time_bucket") <= (end - 1) // partition_seconds) & \
+                   (ds.field("timestamps") >= start) & (ds.field("timestamps") < end)
+        condition = in_range if condition is None else (condition & in_range)
+    
+    columns = columns or ["tripid", "timestamps", "lon", "lat"]
+    trips = dataset.to_table(columns=columns, filter=condition).to_pandas()
+    sort_keys = [col for col in ["tripid", "timestamps"] if col in columns]
+    if sort_keys:
+        trips = trips.sort_values(sort_keys, kind="stable").reset_index(drop=True)
+    return trips
 # %%
 """
 Distorting a trip using Gaussian noise
 """
-def _distort(trip, rate, radius = 50.0):
+"""
+Noise injection : every generator takes (trip, nsplit) and yields the noisy variants of one
+trip (2, traj_len) lazily, the list versions keep the old call sites working.
+nsplit is accepted for the injectnoise interface of createTrainVal, the rates are fixed as before.
+Randomness comes from rng (a np.random.Generator or RandomState), np.random by default
+so that np.random.seed makes the variants reproducible.
+"""
+def downsampling_mask(length, rate, rng=None):
+    """
+    boolean mask of the points kept when dropping each point with probability rate,
+    the first and last points are always kept
+    """
+    rng = np.random if rng is None else rng
+    keep = rng.random(length) > rate
+    if length > 0:
+        keep[[0, -1]] = True
+    return keep
+
+
+def _distort(trip, rate, radius = 50.0, rng=None):
+    """
+    move each point with probability rate by a Gaussian offset of std radius meters
+    """
+    rng = np.random if rng is None else rng
     noisetrip = trip.copy()
-    for i in range(1,noisetrip.shape[0]): # trip 몇개 들어오는거지? shape 맞춰야해.
-        if random.random() <= rate:
-            x, y = lonlat2meters(noisetrip[:,0],noisetrip[:,1])
+    moved = rng.random(trip.shape[1]) <= rate
+    if moved.any():
+        x, y = lonlat2meters(noisetrip[0, moved], noisetrip[1, moved])
+        noise = rng.normal(0., radius, size=(2, len(x)))
+        noisetrip[0, moved], noisetrip[1, moved] = meters2lonlat(x + noise[0], y + noise[1])
+    return noisetrip
 
 
 """
-Accepting one trip and producing its 10 different noise rate distorted variants
+Accepting one trip and producing its 9 different noise rate distorted variants
 """
-def distort(trip, nsplit):
-    noisetrips = []
+def iter_distort(trip, nsplit, rng=None):
+    for rate in np.arange(0., 0.9, 0.1):
+        yield _distort(trip, rate, rng=rng)
+
 
-    for rate in range(0,0.9,0.1):
-        noisetrip = _distort(trip, rate)
-        noisetrips.append(noisetrip)
-    return noisetrips
+def distort(trip, nsplit, rng=None):
+    return list(iter_distort(trip, nsplit, rng=rng))
 
 """
 Downsampling one trip, rate is dropping rate
 """
-def _downsampling(trip, rate):
-    keep_idx = [0]
-    for i in range(1,trip.shape[1]-1): # trip 몇개 들어오는거지? shape 맞춰야해.
-        if random.random() > rate : keep_idx.append(i)
-    keep_idx.append(trip.shape[1]-1)
-    return trip[:, keep_idx].copy()
+def _downsampling(trip, rate, rng=None):
+    return trip[:, downsampling_mask(trip.shape[1], rate, rng=rng)]
 
 
 """
-Accepting one trip and producing its 9 different lowsampling rate variants
+Accepting one trip and producing its 8 different lowsampling rate variants
 """
-def downsampling(trip, nsplit):
-    noisetrips = []
+def iter_downsampling(trip, nsplit, rng=None):
     dropping_rates = np.arange(0.,0.8,0.1)
     for rate in dropping_rates:
-        noisetrip = _downsampling(trip, rate)
-        noisetrips.append(noisetrip)
-    return noisetrips
+        yield _downsampling(trip, rate, rng=rng)
+
+
+def downsampling(trip, nsplit, rng=None):
+    return list(iter_downsampling(trip, nsplit, rng=rng))
 
 """
 First downsampling and then distorting the trip, producing its 20 different variants
 """
-def downsamplingDistort(trip, nsplit):
-    noisetrips = []
+def iter_downsamplingDistort(trip, nsplit, rng=None):
     dropping_rates = [0, 0.2, 0.4, 0.5, 0.6]
     distorting_rates = [0, 0.2, 0.4, 0.6]
     for dropping_rate in dropping_rates :
-        noisetrip1 = downsampling(trip, dropping_rate)
+        noisetrip1 = _downsampling(trip, dropping_rate, rng=rng)
         for distorting_rate in distorting_rates :
-            noisetrip2 = distort(noisetrip1, distorting_rate)
-            noisetrips.append(noisetrip2)
-    return noisetrips
+            yield _distort(noisetrip1, distorting_rate, rng=rng)
+
+
+def downsamplingDistort(trip, nsplit, rng=None):
+    return list(iter_downsamplingDistort(trip, nsplit, rng=rng))
 
 # %%
 """
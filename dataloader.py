@@ -29,6 +29,7 @@ from preprocessing import SpatialRegion
 from constants import Constants
 
 from collections import defaultdict, OrderedDict
+from bisect import bisect_right
 import os
 
 data_dir = pathlib.PosixPath("data/")
@@ -37,8 +38,8 @@ dset_name = "porto"
 subgraph_dir = pathlib.PosixPath("/data/dykim")
 subgraph_dir = subgraph_dir/dset_name/"A_subgraphs"
 fnames = os.listdir(subgraph_dir)
-trains = [h5 for h5 in fnames if h5.startswith("train_traj")]
-vals = [h5 for h5 in fnames if h5.startswith("val_traj")]
+trains = [h5 for h5 in fnames if h5.startswith("train_traj") and h5.endswith(".h5")]
+vals = [h5 for h5 in fnames if h5.startswith("val_traj") and h5.endswith(".h5")]
 
 # [(fname, start_num), ...]
 trains = sorted([(f, int(f.split("_")[-2])) for f in trains], key= lambda x: x[1])
@@ -137,15 +138,15 @@ class TrajDataset(Dataset):
         n_trains=1133657,n_vals=284997, 
         train_processors=36, val_processors=9,
 
+        the file of a sample is the link with the largest start <= index, so the
+        files may hold ranges of any size (n_processors is kept for compatibility)
         """
-        samples_per_file = n_samples//n_processors 
-        self.samples2filelink = {i:i//samples_per_file if i//samples_per_file != n_processors else (n_processors-1) 
-                            for i in range(n_samples)}
         self.data = h5py.File(file_path, "r")
         
         links = list(self.data.keys())
         links = sorted([(link,int(link.split('_')[1])) for link in links], key=lambda x:x[1])
         self.links = links
+        self.link_starts = [start for _, start in links]
         
         self.n_samples = n_samples
         self.n_processors = n_processors
@@ -157,7 +158,7 @@ class TrajDataset(Dataset):
         """
         index is a trajectory number
         """
-        link = self.links[self.samples2filelink[index]]
+        link = self.links[bisect_right(self.link_starts, index)-1]
         edge_index = torch.from_numpy(self.data["{link:}/{num:}/{component:}".format(link=link[0],
                                                   num=index,
                                                   component=components[0])][()]).to(torch.long)
@@ -320,12 +320,8 @@ def vocab2offset_normalized(vocab):
     xoffset = xoffset/graphregion.numx
     return (xoffset, yoffset)
 
-graphregion.vocab2offset_normalized = dict()
-
-for i in range(graphregion.vocab_start):
-    graphregion.vocab2offset_normalized[i] = (0.,0.)
-for vocab in range(graphregion.vocab_start,graphregion.vocab_size):
-    graphregion.vocab2offset_normalized[vocab] = vocab2offset_normalized(vocab)
+# same values as vocab2offset_normalized, computed from the hotcell array at once
+graphregion.vocab2offset_normalized = dict(enumerate(map(tuple, graphregion.vocab_offsets_normalized().tolist())))
 
 class TransformerModel(nn.Module):
 
@@ -742,10 +738,9 @@ def compute_destination_loss(batch, traj_encoder,
     
     # adjacent answers K=20
     vocab_y = batch.x[batch.y].detach().clone() # vocab_index from batch.y(batch-based)
-    cells_y = [graphregion.vocab2hotcell[v.item()] for v in vocab_y] # vocab to cell_id
-    near_cells_y, dist = graphregion.knearest_hotcells(cells_y, config.k_near_vocabs) # kNN of cell_ids
-    # Knear_cell_ids -> vocabs
-    near_vocabs = torch.tensor([[graphregion.hotcell2vocab[cell] for cell in near_cells] for near_cells in near_cells_y]).to(config.device, torch.long)
+    # kNN vocabs from the KNVocabs table (graphregion.save_KNVocabs(k=config.k_near_vocabs))
+    near_vocabs, dist = graphregion.knearest_vocabs(vocab_y.view(-1).cpu().numpy(), config.k_near_vocabs)
+    near_vocabs = torch.from_numpy(near_vocabs).to(config.device, torch.long)
     near_vocabs_emb = traj_encoder.cell_emb(near_vocabs).detach().clone() # (batch_size, K, emb_size)
     # The closer, the bigger penalty
     spatial_weight = nn.Softmax()(-torch.tensor(dist/config.temp).to(config.device),) #(batch_size, K)
@@ -860,10 +855,9 @@ def compute_mask_loss(batch, traj_encoder, mask_proj,
     batch_queries = torch.arange(batch.x.size(0))[(batch.x==3).squeeze()] # (bs,)
     assert batch_queries.size(0) == batch.y.size(0)
     # adjacent answers K=20
-    cells_y = [graphregion.vocab2hotcell[v.item()] for v in batch.y] # vocab to cell_id
-    near_cells_y, dist = graphregion.knearest_hotcells(cells_y, config.k_near_vocabs) # kNN of cell_ids
-    # Knear_cell_ids -> vocabs
-    near_vocabs = torch.tensor([[graphregion.hotcell2vocab[cell] for cell in near_cells] for near_cells in near_cells_y]).to(config.device)
+    # kNN vocabs from the KNVocabs table (graphregion.save_KNVocabs(k=config.k_near_vocabs))
+    near_vocabs, dist = graphregion.knearest_vocabs(batch.y.view(-1).cpu().numpy(), config.k_near_vocabs)
+    near_vocabs = torch.from_numpy(near_vocabs).to(config.device, torch.long)
     near_vocabs_emb = traj_encoder.cell_emb(near_vocabs).detach().clone() # (batch_size, K, emb_size)
     # The closer, the bigger penalty
     spatial_weight = nn.Softmax()(-torch.tensor(dist/config.temp).to(config.device),) #(batch_size, K)
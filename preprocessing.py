@@ -1,18 +1,52 @@
-import h5py
-
 import pandas as pd
 import pathlib
 import folium
 import ast
 from math import sin, ceil, floor
 import numpy as np
-from collections import defaultdict, Counter
+from collections import Counter
 from sklearn.neighbors import KDTree
 import pickle
+import os
+import shutil
+import zlib
+import json
+import multiprocessing
 
 import data_utils as utils
+import tripstore
+from constants import Constants
 
 data_dir = pathlib.PosixPath("data/")
+REGION_ARTIFACT_VERSION = 1
+
+def _count_cells(args):
+    """
+    make_vocab worker : cell counts of the trips numbered start~stop
+    return counts : (numx*numy,), the cells seen with their first point index, 
+           #points out of the region, #trips
+    """
+    region, trips_path, start, stop, zerolen_tripids = args
+    trips = [trip for _, trip in tripstore.iter_trips(trips_path, zerolen_tripids, stop=stop, start=start)]
+    points = np.concatenate(trips, axis=1) if trips else np.empty((2, 0))
+    inregion = region.inregion_mask(points[0], points[1])
+    cell_ids = region.gps2cells(points[0][inregion], points[1][inregion])
+    counts = np.bincount(cell_ids, minlength=region.numx*region.numy)
+    cells, first_idx = np.unique(cell_ids, return_index=True)
+    return counts, cells, first_idx, int((~inregion).sum()), len(trips)
+
+def _trainval_chunk(args):
+    """
+    createTrainValChunked worker
+    """
+    region, trips_path, parts_dir, chunk_i = args[:4]
+    injectnoise, ntrain, nval, nsplit, min_length, max_length, zerolen_tripids, chunk_size, seed, output_format = args[4:]
+    region.createTrainValChunk(trips_path, parts_dir, chunk_i, injectnoise,
+                               ntrain, nval, nsplit=nsplit,
+                               min_length=min_length, max_length=max_length,
+                               zerolen_tripids=zerolen_tripids,
+                               chunk_size=chunk_size, seed=seed, output_format=output_format)
+    return chunk_i
 
 class SpatialRegion(object) : 
     
@@ -45,8 +79,61 @@ class SpatialRegion(object) :
         self.vocab2hotcell, self.vocab_size = None,None
         self.is_built = False
         self.hotcell_kdtree = None
+        self.cell2vocab = None # (numx*numy,) int32, vocab of every cell (or of its nearest hotcell)
         self.build_region()
                 
+    ########## derived from self.hotcell on first use (see load_region_artifact) ##########
+    @property
+    def hotcell2vocab(self):
+        if self._hotcell2vocab is None and self.hotcell is not None:
+            self._hotcell2vocab = dict(zip(self.hotcell.tolist(), range(self.vocab_start, self.vocab_start+len(self.hotcell))))
+        return self._hotcell2vocab
+    
+    @hotcell2vocab.setter
+    def hotcell2vocab(self, value):
+        self._hotcell2vocab = value
+    
+    @property
+    def vocab2hotcell(self):
+        if self._vocab2hotcell is None and self.hotcell is not None:
+            self._vocab2hotcell = dict(zip(range(self.vocab_start, self.vocab_start+len(self.hotcell)), self.hotcell.tolist()))
+        return self._vocab2hotcell
+    
+    @vocab2hotcell.setter
+    def vocab2hotcell(self, value):
+        self._vocab2hotcell = value
+    
+    @property
+    def hotcell_kdtree(self):
+        # only built when a kNN query is made
+        if self._hotcell_kdtree is None and self.hotcell is not None:
+            x, y = self.cell2coord(np.asarray(self.hotcell, dtype=np.int64))
+            self._hotcell_kdtree = KDTree(np.stack([x, y], axis=1))
+        return self._hotcell_kdtree
+    
+    @hotcell_kdtree.setter
+    def hotcell_kdtree(self, value):
+        self._hotcell_kdtree = value
+    
+    @property
+    def cellcount(self):
+        if self._cellcount is None and getattr(self, "_cellcount_arrays", None) is not None:
+            self._cellcount = dict(zip(*[a.tolist() for a in self._cellcount_arrays]))
+        return self._cellcount
+    
+    @cellcount.setter
+    def cellcount(self, value):
+        self._cellcount = value
+        self._cellcount_arrays = None
+    
+    def __setstate__(self, state):
+        # regions pickled before the lazy attributes
+        for name in ["hotcell2vocab", "vocab2hotcell", "hotcell_kdtree", "cellcount"]:
+            if name in state:
+                state["_"+name] = state.pop(name)
+        self.__dict__.update(state)
+    ########################################################################################
+    
     def build_region(self):
         self.minx, self.miny = utils.lonlat2meters(self.minlon,self.minlat)
         self.maxx, self.maxy = utils.lonlat2meters(self.maxlon,self.maxlat)
@@ -100,7 +187,7 @@ class SpatialRegion(object) :
         else : 
             return False
     
-    def make_vocab(self, trips_path, trips_len=None, zerolen_tripids=None):
+    def make_vocab(self, trips_path, trips_len=None, zerolen_tripids=None, processes=None, chunk_size=50000):
         """
         ##### NOT IN USE #### for csv format
         # @param trips_path : pd.DataFrame that trips are concatenated
@@ -111,35 +198,19 @@ class SpatialRegion(object) :
         
         for hd5 format
         @param trips_path ::string ".hd5"; each trip is found in trips["trips/{}".format(num)]
+                            or the ragged layout of tripstore.py
         @param trips_len : None
+        @param processes : workers counting cells of chunk_size trips each; 1 counts in this process
+        
+        hotcells are the maxvocab_size most frequent cells with count >= minfreq,
+        ties broken by the order the cells first appear in the trips
         """
-        self.cellcount = defaultdict(int)
+        counts, first_seen = self.count_cells(trips_path, zerolen_tripids, processes=processes, chunk_size=chunk_size)
+        seen = np.flatnonzero(counts)
+        seen = seen[np.argsort(first_seen[seen], kind="stable")]
+        self.cellcount = dict(zip(seen.tolist(), counts[seen].tolist()))
         
-        num_out_region = 0
-        with h5py.File(trips_path, 'r') as f:
-            for num in range(len(f["trips"].keys())):
-                if num+1 in set(zerolen_tripids): continue
-                trip = f["trips/"+str(num+1)][()] # nd.array (2,traj_len)
-
-                for p in range(trip.shape[1]):
-                    lon, lat = trip[:,p]
-                    if self.is_inregion(lon, lat):
-                        cell_id = self.gps2cell(lon,lat) # cell_id
-                        self.cellcount[cell_id] += 1
-                    else : # not in region
-                        num_out_region += 1
-
-                if num % 300 == 299 : 
-                    print("Processed {} trips".format(num+1))
-                    
-        max_num_hotcells = min(self.maxvocab_size, len(self.cellcount))
-        topcellcount = sorted(self.cellcount.items(), 
-                              key=lambda x : -x[1],)[:max_num_hotcells] # descending
-        print("max_num_hotcells: {} \nmax_count of hotcells: {}".format(max_num_hotcells, topcellcount[0][-1]))
-        
-        # the biggest idx with minfreq
-        minfreq_idx = np.argwhere(np.array(topcellcount)[:,1] == self.minfreq)[-1,0]
-        self.hotcell = np.array([cell_id for cell_id, _ in np.array(topcellcount[:minfreq_idx+1])]) # (len_cell_ids)
+        self.hotcell = self.select_hotcells(counts, seen) # (len_cell_ids)
         print("num of hotcell : {}".format(len(self.hotcell)))
         
         ## build the map between cell and vocab id
@@ -152,11 +223,240 @@ class SpatialRegion(object) :
         self.vocab_size = self.vocab_start + len(self.hotcell)
         
         self.built = True
-        ## build the hot cell kdtree to facilitate search
+        ## the hot cell kdtree to facilitate search is built by the first query
+        self.hotcell_kdtree = None
+        self.build_cell2vocab()
+    
+    def count_cells(self, trips_path, zerolen_tripids=None, processes=None, chunk_size=50000):
+        """
+        number of points of the trips in every cell of the grid
+        return counts : (numx*numy,) int64, 
+               first_seen : (numx*numy,) int64 ordering the cells by their first point in the trips
+        """
+        jobs = [(self, trips_path, start, stop, zerolen_tripids)
+                for start, stop in tripstore.tripnum_ranges(trips_path, chunk_size)]
+        
+        ncells = self.numx * self.numy
+        counts = np.zeros(ncells, dtype=np.int64)
+        first_seen = np.full(ncells, np.iinfo(np.int64).max, dtype=np.int64)
+        num_out_region, num_trips = 0, 0
+        
+        pool = multiprocessing.Pool(processes=processes) if processes != 1 and len(jobs) > 1 else None
+        results = pool.imap(_count_cells, jobs) if pool is not None else map(_count_cells, jobs)
+        try:
+            for chunk_i, (chunk_counts, cells, first_idx, n_out, n_trips) in enumerate(results):
+                counts += chunk_counts
+                # chunks arrive in order : a cell already seen keeps its earlier position
+                unseen = first_seen[cells] == np.iinfo(np.int64).max
+                first_seen[cells[unseen]] = (chunk_i << 40) + first_idx[unseen]
+                num_out_region += n_out
+                num_trips += n_trips
+                print("Processed {} trips".format(num_trips))
+        finally:
+            if pool is not None:
+                pool.terminate()
+        return counts, first_seen
+    
+    def select_hotcells(self, counts, seen):
+        """
+        @param counts : (numx*numy,) point counts, seen : the cells with points in order of first appearance
+        return the hotcells in vocab order
+        """
+        max_num_hotcells = min(self.maxvocab_size, len(seen))
+        # descending count, first appearance among equal counts
+        top = seen[np.argsort(-counts[seen], kind="stable")][:max_num_hotcells]
+        print("max_num_hotcells: {} \nmax_count of hotcells: {}".format(max_num_hotcells, counts[top[0]]))
+        return top[counts[top] >= self.minfreq]
+    
+    def update_vocab(self, trips_path, zerolen_tripids=None, processes=None, chunk_size=50000):
+        """
+        merge the cell counts of a new batch of trips into self.cellcount and append the cells 
+        that now have >= minfreq points to the vocab (up to maxvocab_size hotcells), 
+        so the existing vocab ids, and the embeddings trained on them, stay valid.
+        rerun make_vocab to re-rank the whole vocab.
+        
+        @param trips_path : the new trips, in any layout read by tripstore.iter_trips
+        return crossed : cells whose count crossed minfreq with this batch,
+               new_vocabs : vocab ids appended, of the cells new_hotcells
+        """
+        assert self.built == True
+        counts, first_seen = self.count_cells(trips_path, zerolen_tripids, processes=processes, chunk_size=chunk_size)
+        seen = np.flatnonzero(counts)
+        seen = seen[np.argsort(first_seen[seen], kind="stable")]
+        
+        cellcount = self.cellcount
+        before = np.array([cellcount.get(cell_id, 0) for cell_id in seen.tolist()], dtype=np.int64)
+        after = before + counts[seen]
+        for cell_id, count in zip(seen.tolist(), after.tolist()):
+            cellcount[cell_id] = count
+        crossed = seen[(before < self.minfreq) & (after >= self.minfreq)]
+        
+        # candidates : every cell at minfreq not yet represented by a hotcell, the most frequent first
+        candidates = np.fromiter(cellcount.keys(), dtype=np.int64, count=len(cellcount))
+        candidate_counts = np.fromiter(cellcount.values(), dtype=np.int64, count=len(cellcount))
+        keep = (candidate_counts >= self.minfreq) & self.uncovered_cells(candidates)
+        candidates, candidate_counts = candidates[keep], candidate_counts[keep]
+        new_hotcells = candidates[np.argsort(-candidate_counts, kind="stable")]
+        new_hotcells = new_hotcells[:max(0, self.maxvocab_size - len(self.hotcell))]
+        
+        new_vocabs = np.arange(self.vocab_size, self.vocab_size + len(new_hotcells))
+        # in memory : the arrays loaded from a region artifact are memmaps of the files saved over next
+        self.hotcell = np.concatenate([np.asarray(self.hotcell, dtype=np.int64), new_hotcells])
+        self.cell2vocab = np.array(self.cell2vocab)
+        if len(new_hotcells) > 0:
+            self.vocab_size = self.vocab_start + len(self.hotcell)
+            self.hotcell2vocab, self.vocab2hotcell, self.hotcell_kdtree = None, None, None
+            # tables of knearest_vocabs were built for the former vocab
+            self._knvocabs, self._knvocabs_missing = {}, set()
+            self.build_cell2vocab()
+        print("cells crossing minfreq: {} \nappended hotcells: {} \nvocab_size: {}".format(
+            len(crossed), len(new_hotcells), self.vocab_size))
+        return crossed, new_vocabs
+    
+    def uncovered_cells(self, cell_ids):
+        """
+        mask of the cell_ids that are not hotcells
+        """
+        cell_ids = np.asarray(cell_ids, dtype=np.int64)
+        return self.hotcell[self.cell2vocab[cell_ids] - self.vocab_start] != cell_ids
+    
+    def vocab_offsets_normalized(self):
+        """
+        (vocab_size, 2) : (xoffset/numx, yoffset/numy) of the hotcell of every vocab, 0 for the special vocabs
+        """
+        hotcell = np.asarray(self.hotcell, dtype=np.int64)
+        offsets = np.zeros((self.vocab_size, 2))
+        offsets[self.vocab_start:, 0] = (hotcell % self.numx) / self.numx
+        offsets[self.vocab_start:, 1] = (hotcell // self.numx) / self.numy
+        return offsets
+    
+    def build_cell2vocab(self, chunk_size=1000000):
+        """
+        precompute the vocab of every cell of the grid, a non-hot cell taking the vocab of its nearest hotcell,
+        so that anycell2vocab/cells2vocabs become an array index.
+        """
+        assert self.built == True
+        hotcell = np.asarray(self.hotcell, dtype=np.int64)
+        self.cell2vocab = np.empty(self.numx*self.numy, dtype=np.int32)
+        for start in range(0, len(self.cell2vocab), chunk_size):
+            cell_ids = np.arange(start, min(start+chunk_size, len(self.cell2vocab)), dtype=np.int64)
+            x, y = self.cell2coord(cell_ids)
+            _, indice = self.hotcell_kdtree.query(np.stack([x, y], axis=1), k=1) # indice of self.hotcell
+            self.cell2vocab[start:start+len(cell_ids)] = indice[:, 0] + self.vocab_start
+        # a hotcell is always its own vocab, whatever the kdtree does with ties
+        self.cell2vocab[hotcell] = np.arange(len(hotcell)) + self.vocab_start
+        return self.cell2vocab
+    
+    def save_spatialregion_info(self, data_dir, fname):
+        """
+        save the region info into data_dir/dataset_name/region_info/fname (.pkl), 
+        the keys read by load_spatialregion_info()
+        """
+        dirname = data_dir/self.dataset_name/"region_info"
+        os.makedirs(dirname, exist_ok=True)
+        info = {"cellcount": self.cellcount, "hotcell": self.hotcell,
+                "hotcell2vocab": self.hotcell2vocab, "vocab2hotcell": self.vocab2hotcell,
+                "vocab_size": self.vocab_size, "hotcell_kdtree": self.hotcell_kdtree,
+                "cell2vocab": self.cell2vocab, "built": self.built}
+        with open(dirname/fname, "wb") as f:
+            pickle.dump(info, f)
+        self.save_region_artifact(dirname/self.region_artifact_name(fname))
+    
+    @staticmethod
+    def region_artifact_name(fname):
+        """
+        the artifact directory stored next to a .pkl region info: "portomap.pkl" -> "portomap.region"
+        """
+        return os.path.splitext(str(fname))[0] + ".region"
+    
+    def region_artifact_meta(self):
+        return {"version": REGION_ARTIFACT_VERSION, "dataset_name": self.dataset_name,
+                "minlon": self.minlon, "minlat": self.minlat, "maxlon": self.maxlon, "maxlat": self.maxlat,
+                "xstep": self.xstep, "ystep": self.ystep, "numx": self.numx, "numy": self.numy,
+                "vocab_start": self.vocab_start,
+                "vocab_size": None if self.vocab_size is None else int(self.vocab_size)}
+    
+    def save_region_artifact(self, dirname):
+        """
+        save the built region as .npy arrays + meta.json in dirname:
+            hotcell.npy : (#hotcells,) int64, hotcell[i] is the cell of vocab i+vocab_start
+            cell2vocab.npy : (numx*numy,) int32
+            cellcount_cells.npy, cellcount_counts.npy : (#cells seen,) int64
+        the dicts and the kd-tree are derived from hotcell when first used
+        
+        the artifact is written into a sibling dirname.tmp and then swapped in, so that the arrays 
+        of a region loaded from dirname (memmaps of its files) are never overwritten
+        and a half-written artifact is never read
+        """
+        assert self.built == True
+        dirname = str(dirname)
+        tmp, old = dirname + ".tmp", dirname + ".old"
+        for d in [tmp, old]:
+            shutil.rmtree(d, ignore_errors=True)
+        os.makedirs(tmp)
+        cellcount = self.cellcount or {}
+        np.save(os.path.join(tmp, "hotcell.npy"), np.asarray(self.hotcell, dtype=np.int64))
+        np.save(os.path.join(tmp, "cell2vocab.npy"), self.cell2vocab)
+        np.save(os.path.join(tmp, "cellcount_cells.npy"), np.fromiter(cellcount.keys(), dtype=np.int64, count=len(cellcount)))
+        np.save(os.path.join(tmp, "cellcount_counts.npy"), np.fromiter(cellcount.values(), dtype=np.int64, count=len(cellcount)))
+        # meta last : a directory without meta.json is an unfinished artifact
+        with open(os.path.join(tmp, "meta.json"), "w") as f:
+            json.dump(self.region_artifact_meta(), f)
+        # a directory cannot be replaced by rename : move the previous artifact aside first;
+        # in between, load_spatialregion_info falls back to the .pkl
+        if os.path.exists(dirname):
+            os.replace(dirname, old)
+        os.replace(tmp, dirname)
+        shutil.rmtree(old, ignore_errors=True)
+    
+    def load_region_artifact(self, dirname):
+        """
+        memory-map a region saved by save_region_artifact()
+        raise ValueError when the artifact has another version or does not describe this region's grid
+        """
+        with open(os.path.join(dirname, "meta.json"), "r") as f:
+            meta = json.load(f)
+        expected = self.region_artifact_meta()
+        expected["vocab_size"] = meta.get("vocab_size")
+        if meta != expected:
+            raise ValueError("region artifact {} does not match this region (or version {}): {}".format(
+                dirname, REGION_ARTIFACT_VERSION, meta))
+        
+        self.hotcell = np.load(os.path.join(dirname, "hotcell.npy"), mmap_mode="r")
+        self.cell2vocab = np.load(os.path.join(dirname, "cell2vocab.npy"), mmap_mode="r")
+        self.vocab_size = meta["vocab_size"]
+        self.hotcell2vocab, self.vocab2hotcell, self.hotcell_kdtree = None, None, None
+        self.cellcount = None
+        self._cellcount_arrays = (np.load(os.path.join(dirname, "cellcount_cells.npy"), mmap_mode="r"),
+                                  np.load(os.path.join(dirname, "cellcount_counts.npy"), mmap_mode="r"))
+        self.built = True
+    
+    def load_spatialregion_info(self, data_dir, fname):
+        """
+        load the following region info from .pkl file: 'cellcount', 'hotcell', 
+        'hotcell2vocab', 'vocab2hotcell','vocab_size', 'hotcell_kdtree', 'built'
+        and 'cell2vocab' (rebuilt when the file predates it)
+        the region artifact (region_artifact_name(fname)) is loaded instead when it exists
+
+        load_spatialregion_info(data_dir, "portomap.pkl")
+        """
+        file_path = data_dir/self.dataset_name/"region_info"/fname
+        self.region_info_dir = data_dir/self.dataset_name/"region_info"
+        artifact = data_dir/self.dataset_name/"region_info"/self.region_artifact_name(fname)
+        if os.path.exists(artifact/"meta.json"):
+            return self.load_region_artifact(artifact)
+        info = pickle.load(open(file_path, "rb"))
         
-        # coord : (len_hotcells, 2: (x,y))
-        coord = np.array(list(map(self.cell2coord, self.hotcell))) # self.hotcell : (len_hotcells)
-        self.hotcell_kdtree = KDTree(coord)
+        self.cellcount= info["cellcount"]
+        self.hotcell= info["hotcell"]
+        self.hotcell2vocab= info["hotcell2vocab"]
+        self.vocab2hotcell= info["vocab2hotcell"]
+        self.vocab_size= info["vocab_size"]
+        self.hotcell_kdtree= info["hotcell_kdtree"]
+        self.built= True
+        self.cell2vocab = info.get("cell2vocab")
+        if self.cell2vocab is None or len(self.cell2vocab) != self.numx*self.numy:
+            self.build_cell2vocab()
 
     def knearest_hotcells(self, cell_ids, k):
         """
@@ -165,7 +465,8 @@ class SpatialRegion(object) :
         """
         assert self.built == True
         ## cell_ids should be iterable
-        coord = np.array(list(map(self.cell2coord, cell_ids))) # (len_hotcells, 2: (x,y))
+        x, y = self.cell2coord(np.asarray(list(cell_ids), dtype=np.int64))
+        coord = np.stack([x, y], axis=1).reshape(-1, 2) # (len_hotcells, 2: (x,y))
         dists, indice = self.hotcell_kdtree.query(coord,k=k) # indice here is indice of self.hotcell
         return self.hotcell[indice], dists 
     
@@ -176,29 +477,111 @@ class SpatialRegion(object) :
         cell_id,_ = self.knearest_hotcells(cell_ids, k=1)
         return cell_id # : (None, 1)
     
-    def save_KNVocabs(self,):
-        V, D = np.zeros((self.knn_k, self.vocab_size)), np.zeros((self.knn_k, self.vocab_size))
-        for vocab in range(self.vocab_start):
-            V[:, vocab] = vocab
-            D[:, vocab] = 0.
-            
-        kcells, dists = self.knearest_hotcells(list(self.vocab2hotcell.values()), k=5) # (#hotcells, k)
-        uniq, inv = np.unique(kcells, return_inverse = True)
-        kvocabs = np.array([self.hotcell2vocab[u_cell] for u_cell in uniq])[inv].reshape(kcells.shape)
-        print(kvocabs.shape)
+    def build_KNVocabs(self, k=None, chunk_size=100000, prefix=None):
+        """
+        the k nearest vocabs of every vocab and their distances (meters), nearest first;
+        a vocab is its own nearest and the special vocabs only have themselves at distance 0
+        @param k : defaults to self.knn_k
+        @param prefix : when given, V and D are written by chunks to prefix.V.npy / prefix.D.npy
+        return V : (vocab_size, k) int32, D : (vocab_size, k) float32
+        """
+        assert self.built == True
+        k = self.knn_k if k is None else k
+        if prefix is None:
+            V = np.empty((self.vocab_size, k), dtype=np.int32)
+            D = np.empty((self.vocab_size, k), dtype=np.float32)
+        else:
+            V = np.lib.format.open_memmap(str(prefix)+".V.npy", mode="w+", dtype=np.int32, shape=(self.vocab_size, k))
+            D = np.lib.format.open_memmap(str(prefix)+".D.npy", mode="w+", dtype=np.float32, shape=(self.vocab_size, k))
+        V[:self.vocab_start] = np.arange(self.vocab_start)[:, None]
+        D[:self.vocab_start] = 0.
         
-        V[:, self.vocab_start:] = kvocabs.transpose().astype('int')
-        D[:, self.vocab_start:] = dists.transpose()
+        hotcell = np.asarray(self.hotcell, dtype=np.int64)
+        for start in range(0, len(hotcell), chunk_size):
+            x, y = self.cell2coord(hotcell[start:start+chunk_size])
+            dists, indice = self.hotcell_kdtree.query(np.stack([x, y], axis=1), k=k) # indice of self.hotcell
+            V[self.vocab_start+start:self.vocab_start+start+len(x)] = indice + self.vocab_start
+            D[self.vocab_start+start:self.vocab_start+start+len(x)] = dists
+        if prefix is not None:
+            V.flush()
+            D.flush()
+        return V, D
+    
+    def KNVocabs_prefix(self, dirname, k):
+        return dirname/"{ds}KNVocabs_{cell_sz}_k{k}".format(ds=self.dataset_name, cell_sz=self.xstep, k=k)
+    
+    def load_KNVocabs(self, dirname, k):
+        """
+        memory-map the tables written by save_KNVocabs(k=k) in dirname (the region_info directory), 
+        used by knearest_vocabs from then on
+        """
+        prefix = str(self.KNVocabs_prefix(pathlib.PosixPath(dirname), k))
+        V = np.load(prefix+".V.npy", mmap_mode="r")
+        D = np.load(prefix+".D.npy", mmap_mode="r")
+        if V.shape[0] != self.vocab_size:
+            raise ValueError("{} was built for another vocab ({} vocabs)".format(prefix, V.shape[0]))
+        self._knvocabs = getattr(self, "_knvocabs", {})
+        self._knvocabs[k] = (V, D)
+        self._knvocabs_missing = getattr(self, "_knvocabs_missing", set()) - {k}
+        return V, D
+    
+    def knearest_vocabs(self, vocabs, k):
+        """
+        @param vocabs : nd.array of vocab ids
+        return knearest vocabs : (*vocabs.shape, k) int32, knndists : (*vocabs.shape, k) float32
+        from the tables of load_KNVocabs, which are looked for in the region_info directory 
+        of load_spatialregion_info on first use, or from the kd-tree without them
+        """
+        vocabs = np.asarray(vocabs, dtype=np.int64)
+        tables = getattr(self, "_knvocabs", {})
+        missing = getattr(self, "_knvocabs_missing", set())
+        if k not in tables and k not in missing and getattr(self, "region_info_dir", None) is not None:
+            try:
+                self.load_KNVocabs(self.region_info_dir, k)
+            except (OSError, ValueError):
+                self._knvocabs_missing = missing | {k} # do not look again for this k
+            tables = getattr(self, "_knvocabs", {})
+        if k in tables:
+            V, D = tables[k]
+            return np.asarray(V[vocabs]), np.asarray(D[vocabs])
+        
+        V = np.repeat(vocabs[..., None], k, axis=-1).astype(np.int32)
+        D = np.zeros(vocabs.shape + (k,), dtype=np.float32)
+        hot = vocabs >= self.vocab_start
+        if hot.any():
+            x, y = self.cell2coord(np.asarray(self.hotcell)[vocabs[hot] - self.vocab_start])
+            dists, indice = self.hotcell_kdtree.query(np.stack([x, y], axis=1), k=k)
+            V[hot], D[hot] = indice + self.vocab_start, dists
+        return V, D
+    
+    def save_KNVocabs(self, k=None, chunk_size=100000):
+        """
+        write the (vocab_size, k) tables of build_KNVocabs into data_dir/dataset_name/region_info
+        as .npy files (see load_KNVocabs), plus the former pickle {"V": (k, vocab_size), "D": (k, vocab_size)}
+        """
+        k = self.knn_k if k is None else k
+        dirname = data_dir/self.dataset_name/"region_info"
+        os.makedirs(dirname, exist_ok=True)
+        # built under temporary names then renamed : tables already memory-mapped stay readable
+        prefix = str(self.KNVocabs_prefix(dirname, k))
+        V, D = self.build_KNVocabs(k, chunk_size=chunk_size, prefix=prefix+".tmp")
+        for ext in [".V.npy", ".D.npy"]:
+            os.replace(prefix+".tmp"+ext, prefix+ext)
+        self.load_KNVocabs(dirname, k) # knearest_vocabs uses the new tables from now on
+        print(V.shape)
         
-        pickle.dump({"V": V,"D": D}, 
+        pickle.dump({"V": V.T.astype(np.float64), "D": D.T.astype(np.float64)}, 
                     open(data_dir/self.dataset_name/"{ds}KNVocabs_{cell_sz}.pkl".format(ds = self.dataset_name,
                                                                                         cell_sz = self.xstep
                                                                                        ), "wb"))
+        
     def anycell2vocab(self, cell_id):
         """
         mapping a cell_id to vocab where the cell_id is not necessarily a hotcell
         if a cell_id is not one of hotcells, it is replaced with the nearest hotcell.
         """
+        if getattr(self, "cell2vocab", None) is not None and 0 <= cell_id < len(self.cell2vocab):
+            return int(self.cell2vocab[cell_id])
         if cell_id in self.hotcell2vocab: # one of hotcells
             return self.hotcell2vocab[cell_id]
         else: # not a hotcell
@@ -224,15 +607,161 @@ class SpatialRegion(object) :
             
         return seq
     
+    ########## array versions : whole (2, N) arrays or many trips concatenated ##########
+    def coords2cells(self, x, y):
+        """
+        vectorized coord2cell
+        @param x, y : nd.array in meter metric
+        """
+        xoffset = np.floor(np.round(np.asarray(x) - self.minx, 6) / self.xstep).astype(np.int64)
+        yoffset = np.floor(np.round(np.asarray(y) - self.miny, 6) / self.ystep).astype(np.int64)
+        return yoffset * self.numx + xoffset
+    
+    def gps2cells(self, lon, lat):
+        """
+        vectorized gps2cell
+        """
+        x, y = utils.lonlat2meters(np.asarray(lon, dtype=np.float64), np.asarray(lat, dtype=np.float64))
+        return self.coords2cells(x, y)
+    
+    def inregion_mask(self, lon, lat):
+        """
+        vectorized is_inregion
+        """
+        lon, lat = np.asarray(lon), np.asarray(lat)
+        return (self.minlon <= lon) & (lon < self.maxlon) & (self.minlat <= lat) & (lat < self.maxlat)
+    
+    def cells2vocabs(self, cell_ids):
+        """
+        vectorized anycell2vocab : a cell that is not a hotcell takes the vocab of its nearest hotcell
+        @param cell_ids : nd.array of cell_ids in the region
+        """
+        cell_ids = np.asarray(cell_ids, dtype=np.int64)
+        if getattr(self, "cell2vocab", None) is not None:
+            ingrid = (0 <= cell_ids) & (cell_ids < len(self.cell2vocab))
+            if ingrid.all():
+                return self.cell2vocab[cell_ids].astype(np.int64)
+        if getattr(self, "_sorted_hotcell_of", None) is not self.hotcell:
+            order = np.argsort(self.hotcell, kind="stable")
+            self._sorted_hotcell = self.hotcell[order].astype(np.int64)
+            self._sorted_hotcell_vocab = order.astype(np.int64) + self.vocab_start
+            self._sorted_hotcell_of = self.hotcell
+        
+        def lookup(cells):
+            pos = np.clip(np.searchsorted(self._sorted_hotcell, cells), 0, len(self._sorted_hotcell)-1)
+            return pos, self._sorted_hotcell[pos] == cells
+        
+        pos, hit = lookup(cell_ids)
+        vocabs = np.where(hit, self._sorted_hotcell_vocab[pos], Constants.UNK)
+        if not hit.all():
+            # one kd-tree query per distinct non-hot cell
+            uniq, inv = np.unique(cell_ids[~hit], return_inverse=True)
+            nearest = self.knearest_hotcells(uniq, k=1)[0][:, 0]
+            vocabs[~hit] = self._sorted_hotcell_vocab[lookup(nearest)[0]][inv]
+        return vocabs
+    
+    def gps2vocabs(self, lon, lat):
+        """
+        vectorized gps2vocab; points out of the region are Constants.UNK instead of "UNK"
+        """
+        lon, lat = np.asarray(lon, dtype=np.float64), np.asarray(lat, dtype=np.float64)
+        inregion = self.inregion_mask(lon, lat)
+        vocabs = np.full(lon.shape, Constants.UNK, dtype=np.int64)
+        vocabs[inregion] = self.cells2vocabs(self.gps2cells(lon[inregion], lat[inregion]))
+        return vocabs
+    
+    def trip2seq_array(self, trip):
+        """
+        vectorized trip2seq
+        @param trip : (2, traj_len) ::nd.array, or (2, #points) of many trips concatenated
+        return (traj_len,) int64 with Constants.UNK for points out of the region
+        """
+        return self.gps2vocabs(trip[0], trip[1])
+    
+    def trips2seqs(self, trips):
+        """
+        tokenizing many trips in one call
+        @param trips : list of (2, traj_len) ::nd.array
+        return vocabs : (#points,) int64, offsets : (#trips+1,) ; trip i is vocabs[offsets[i]:offsets[i+1]]
+        """
+        offsets = np.zeros(len(trips)+1, dtype=np.int64)
+        np.cumsum([trip.shape[1] for trip in trips], out=offsets[1:])
+        if len(trips) == 0:
+            return np.empty(0, dtype=np.int64), offsets
+        return self.trip2seq_array(np.concatenate(trips, axis=1)), offsets
+    
+    def gps2offsets(self, lon, lat):
+        """
+        vectorized gps2offset
+        """
+        x, y = utils.lonlat2meters(np.asarray(lon, dtype=np.float64), np.asarray(lat, dtype=np.float64))
+        xoffset = np.round(x - self.minx, 6) / self.xstep
+        yoffset = np.round(y - self.miny, 6) / self.ystep
+        return xoffset, yoffset
+    
+    def tripsmeta(self, points, offsets):
+        """
+        vectorized tripmeta of non-empty trips concatenated
+        @param points : (2, #points), offsets : (#trips+1,)
+        return (#trips, 2) : xoffset, yoffset of each trip's bounding-box centroid
+        """
+        starts = np.asarray(offsets[:-1], dtype=np.int64)
+        mins = np.minimum.reduceat(points, starts, axis=1)
+        maxs = np.maximum.reduceat(points, starts, axis=1)
+        lon_centroid, lat_centroid = mins + (maxs-mins)/2
+        return np.stack(self.gps2offsets(lon_centroid, lat_centroid), axis=1)
+    
+    def vocabs2str(self, vocabs):
+        """
+        seq2str of vocabs from the array versions, Constants.UNK written as "UNK"
+        """
+        return " ".join(["UNK" if vocab == Constants.UNK else str(vocab) for vocab in vocabs.tolist()]) + "\n"
+    ########################################################################################
+    
     def seq2trip(self,seq):
-        trip = np.zeros((2,len(seq)),dtype=np.float32)
-        for point in range(len(seq)):
-            hotcell_id = self.vocab2hotcell.get(seq[point], -1)
-            if hotcell_id == -1 : raise ValueError
-            lon, lat = self.cell2gps(hotcell_id)
-            trip[:, point] = np.array([lon, lat])
-            
-        return trip
+        return self.vocabs2gps(np.asarray(seq, dtype=np.int64)).astype(np.float32)
+    
+    def vocab_centroids(self):
+        """
+        (vocab_size, 2) lon, lat of the hotcell of every vocab, nan for the special vocabs
+        computed once per vocab
+        """
+        if getattr(self, "_vocab_centroids_of", None) is not self.hotcell:
+            centroids = np.full((self.vocab_size, 2), np.nan)
+            lon, lat = self.cell2gps(np.asarray(self.hotcell, dtype=np.int64))
+            centroids[self.vocab_start:, 0], centroids[self.vocab_start:, 1] = lon, lat
+            self._vocab_centroids, self._vocab_centroids_of = centroids, self.hotcell
+        return self._vocab_centroids
+    
+    def vocabs2gps(self, vocabs, strict=True):
+        """
+        vectorized seq2trip
+        @param vocabs : nd.array of vocab ids, of any shape
+        @param strict : raise ValueError on special or unknown vocabs as seq2trip does, 
+                        otherwise they decode to nan
+        return (2, *vocabs.shape) lon, lat
+        """
+        vocabs = np.asarray(vocabs, dtype=np.int64)
+        valid = (self.vocab_start <= vocabs) & (vocabs < self.vocab_size)
+        if strict and not valid.all():
+            raise ValueError("vocabs without a hotcell: {}".format(np.unique(vocabs[~valid])[:10]))
+        gps = self.vocab_centroids()[np.where(valid, vocabs, 0)] # (*vocabs.shape, 2), row 0 is nan
+        return np.moveaxis(gps, -1, 0)
+    
+    def seqs2trips(self, vocabs, offsets=None, strict=True):
+        """
+        decoding a ragged batch of sequences
+        @param vocabs, offsets : (#tokens,) vocabs and (#seqs+1,) offsets as returned by trips2seqs
+                                 or stored by tripstore.TokenSeqStore; return points (2, #tokens)
+               vocabs : a list of sequences when offsets is None; return a list of (2, seq_len) trips
+        """
+        if offsets is not None:
+            return self.vocabs2gps(vocabs, strict=strict)
+        if len(vocabs) == 0:
+            return []
+        lengths = np.cumsum([len(seq) for seq in vocabs])[:-1]
+        flat = np.concatenate([np.asarray(seq, dtype=np.int64) for seq in vocabs])
+        return np.split(self.vocabs2gps(flat, strict=strict), lengths, axis=1)
     
     def tripmeta(self, trip):
         """
@@ -244,7 +773,7 @@ class SpatialRegion(object) :
         return xoffset, yoffset
     
     def seqmeta(self, seq):
-        trip = self.seq2traj(seq)
+        trip = self.seq2trip(seq)
         return self.tripmeta(trip)
     
     def seq2str(self, seq):
@@ -254,50 +783,190 @@ class SpatialRegion(object) :
         seq_str = " ".join(list(map(str, seq))) + "\n"
         return seq_str
         
+    def write_trainval_trip(self, trip, injectnoise, nsplit, srcio, trgio, mtaio, rng=None):
+        """
+        write the noisy variants of a trip (src) aligned with the trip itself (trg) and its meta (mta)
+        @param trip : (2, traj_len) ::nd.array
+        @param srcio, trgio, mtaio : text files, or tripstore.TokenSeqWriter/MetaWriter for the binary format
+        @param rng : passed to injectnoise when given, np.random is used otherwise
+        """
+        binary = isinstance(srcio, tripstore.TokenSeqWriter)
+        trg = self.trip2seq_array(trip)
+        meta = self.tripmeta(trip)
+#         print(meta)
+        if not binary:
+            trg = self.vocabs2str(trg)
+            meta = "{:.2f} {:.2f}\n".format(meta[0], meta[1])
+
+        noisetrips = injectnoise(trip, nsplit) if rng is None else injectnoise(trip, nsplit, rng=rng)
+        for noisetrip in noisetrips:
+            src = self.trip2seq_array(noisetrip)
+            if binary:
+                srcio.append(src)
+                trgio.append(trg)
+                mtaio.append(meta)
+            else:
+                srcio.write(self.vocabs2str(src))
+                trgio.write(trg)
+                mtaio.write(meta)
+    
+    @staticmethod
+    def open_trainval_ios(prefix, output_format):
+        """
+        (src, trg, mta) outputs of prefix ("train", "valid", ...) 
+        output_format "text" : prefix.src/.trg/.mta text files
+                      "binary" : prefix.src and prefix.trg token sequences, prefix.mta.npy (see tripstore.py)
+        """
+        prefix = str(prefix)
+        if output_format == "binary":
+            return (tripstore.TokenSeqWriter(prefix+".src"), tripstore.TokenSeqWriter(prefix+".trg"),
+                    tripstore.MetaWriter(prefix+".mta"))
+        elif output_format == "text":
+            return open(prefix+".src", "w"), open(prefix+".trg", "w"), open(prefix+".mta", "w")
+        raise ValueError("unknown output_format {}".format(output_format))
+        
     def createTrainVal(self, trips_path, datapath, injectnoise,
                        ntrain, nval, nsplit=5, min_length=20, max_length=100,
-                       zerolen_tripids=None
+                       zerolen_tripids=None, output_format="text"
                       ):
         """
         @param datapath :: pathlib.POSIX("datapath")
-        self.createTrainVal(trip_path, datapath, utils.downsampling,
+        self.createTrainVal(trip_path, datapath, utils.iter_downsampling,
                         800, 200, nsplit=5, min_length=20, max_length=100)
         @param zerolen_tripids :: list
+        @param output_format : "text" or "binary" (see open_trainval_ios)
         """
-        trainsrc = open(datapath/self.dataset_name/"train.src", "w")
-        traintrg = open(datapath/self.dataset_name/"train.trg", "w")
-        trainmta = open(datapath/self.dataset_name/"train.mta", "w")
-        
-        validsrc = open(datapath/self.dataset_name/"valid.src", "w")
-        validtrg = open(datapath/self.dataset_name/"valid.trg", "w")
-        validmta = open(datapath/self.dataset_name/"valid.mta", "w")
-        
-        with h5py.File(trips_path, 'r') as f:
-            for num in range(ntrain+nval):
-                if num % 300 == 299 : 
-                    print("Scanned {} trips".format(num+1))
-                    
-                if num+1 in set(zerolen_tripids): continue
-                    
-                trip = f["trips/"+str(num+1)][()] # nd.array (2,traj_len)                
-                if not (min_length<= trip.shape[1]<=max_length):continue
-                    
-                trg = self.seq2str(self.trip2seq(trip))
-                meta = self.tripmeta(trip)
-#                 print(meta)
-                mta = "{:.2f} {:.2f}\n".format(meta[0], meta[1])
-                    
-                noisetrips = injectnoise(trip, nsplit)
-                srcio, trgio, mtaio = (trainsrc,traintrg,trainmta) if num<ntrain else (validsrc,validtrg,validmta)
-                for noisetrip in noisetrips:
-                    src = self.seq2str(self.trip2seq(noisetrip))
-                    srcio.write(src)
-                    trgio.write(trg)
-                    mtaio.write(mta)
+        trainsrc, traintrg, trainmta = self.open_trainval_ios(datapath/self.dataset_name/"train", output_format)
+        validsrc, validtrg, validmta = self.open_trainval_ios(datapath/self.dataset_name/"valid", output_format)
+        
+        # trip numbers 1~ntrain are train, ntrain+1~ntrain+nval are valid
+        for trip_num, trip in tripstore.iter_trips(trips_path, zerolen_tripids, stop=ntrain+nval):
+            num = trip_num - 1
+            if num % 300 == 299 : 
+                print("Scanned {} trips".format(num+1))
+
+            if not (min_length<= trip.shape[1]<=max_length):continue
+
+            srcio, trgio, mtaio = (trainsrc,traintrg,trainmta) if num<ntrain else (validsrc,validtrg,validmta)
+            self.write_trainval_trip(trip, injectnoise, nsplit, srcio, trgio, mtaio)
         
         trainsrc.close()
         traintrg.close()
         trainmta.close()
         validsrc.close()
         validtrg.close()
-        validmta.close()
\ No newline at end of file
+        validmta.close()
+        
+    def vocab_fingerprint(self):
+        """
+        [vocab_size, crc32 of hotcell, crc32 of cell2vocab] : changes when the vocab is rebuilt or updated
+        """
+        cell2vocab = getattr(self, "cell2vocab", None)
+        return [int(self.vocab_size),
+                zlib.crc32(np.ascontiguousarray(self.hotcell, dtype=np.int64).tobytes()),
+                zlib.crc32(np.ascontiguousarray(cell2vocab, dtype=np.int32).tobytes()) if cell2vocab is not None else None]
+    
+    def createTrainValChunk(self, trips_path, parts_dir, chunk_i, injectnoise,
+                            ntrain, nval, nsplit=5, min_length=20, max_length=100,
+                            zerolen_tripids=None, chunk_size=10000, seed=0, output_format="text"):
+        """
+        createTrainVal on trip numbers chunk_i*chunk_size+1 ~ (chunk_i+1)*chunk_size
+        written to parts_dir/chunk_{chunk_i}.{train,valid}.{src,trg,mta}
+        the noise comes from a RandomState seeded by seed+chunk_i so that a chunk always produces
+        the same lines, the global np.random state is left untouched
+        """
+        rng = np.random.RandomState(seed + chunk_i)
+        
+        ios = {}
+        for split in ["train", "valid"]:
+            prefix = parts_dir/"chunk_{:05d}.{}".format(chunk_i, split)
+            ios[split, "src"], ios[split, "trg"], ios[split, "mta"] = self.open_trainval_ios(prefix, output_format)
+        
+        start = chunk_i*chunk_size + 1
+        stop = min((chunk_i+1)*chunk_size, ntrain+nval)
+        for trip_num, trip in tripstore.iter_trips(trips_path, zerolen_tripids, start=start, stop=stop):
+            if not (min_length<= trip.shape[1]<=max_length):continue
+            split = "train" if trip_num <= ntrain else "valid"
+            self.write_trainval_trip(trip, injectnoise, nsplit,
+                                     ios[split, "src"], ios[split, "trg"], ios[split, "mta"], rng=rng)
+        
+        for io in ios.values():
+            io.close()
+        
+    def createTrainValChunked(self, trips_path, datapath, injectnoise,
+                              ntrain, nval, nsplit=5, min_length=20, max_length=100,
+                              zerolen_tripids=None, chunk_size=10000, seed=0, resume=True, processes=None,
+                              output_format="text"):
+        """
+        resumable, multi-process createTrainVal
+        trip numbers are processed in chunks recorded in datapath/dataset_name/trainval.parts/manifest.json;
+        a rerun only processes the missing chunks, then the parts are concatenated in order,
+        so train/valid files are byte-identical to an uninterrupted run whatever the number of processes.
+        the lines of every chunk are listed in datapath/dataset_name/trainval.index.json
+        @param processes : workers building chunks; 1 builds them in this process
+        @param output_format : "text" or "binary" (see open_trainval_ios)
+        
+        self.createTrainValChunked(trip_path, datapath, utils.iter_downsampling,
+                                   800, 200, nsplit=5, min_length=20, max_length=100)
+        """
+        parts_dir = datapath/self.dataset_name/"trainval.parts"
+        os.makedirs(parts_dir, exist_ok=True)
+        manifest_path = str(parts_dir/"manifest.json")
+        
+        zerolen = np.unique(np.asarray(zerolen_tripids if zerolen_tripids is not None else [], dtype=np.int64))
+        params = {"trips_path": str(trips_path), "injectnoise": injectnoise.__name__,
+                  "ntrain": ntrain, "nval": nval, "nsplit": nsplit,
+                  "min_length": min_length, "max_length": max_length,
+                  "zerolen_tripids": [len(zerolen), zlib.crc32(zerolen.tobytes())],
+                  "chunk_size": chunk_size, "seed": seed, "output_format": output_format,
+                  "vocab": self.vocab_fingerprint()}
+        manifest = utils.load_manifest(manifest_path, params) if resume else {"params": params, "chunks": {}}
+        
+        nchunks = ceil((ntrain+nval) / chunk_size)
+        jobs = [(self, trips_path, parts_dir, chunk_i, injectnoise, ntrain, nval, nsplit,
+                 min_length, max_length, zerolen_tripids, chunk_size, seed, output_format)
+                for chunk_i in range(nchunks) if str(chunk_i) not in manifest["chunks"]]
+        
+        pool = multiprocessing.Pool(processes=processes) if processes != 1 and len(jobs) > 1 else None
+        results = pool.imap_unordered(_trainval_chunk, jobs) if pool is not None else map(_trainval_chunk, jobs)
+        try:
+            for n_done, chunk_i in enumerate(results):
+                manifest["chunks"][str(chunk_i)] = True
+                utils.save_manifest(manifest_path, manifest)
+                print("Scanned {} chunks of {} trips".format(nchunks - len(jobs) + n_done + 1, chunk_size))
+        finally:
+            if pool is not None:
+                pool.terminate()
+        
+        # merge the chunks in order, indexing the lines each chunk contributes
+        index = {"chunk_size": chunk_size, "train": [], "valid": []}
+        for split in ["train", "valid"]:
+            prefixes = [str(parts_dir/"chunk_{:05d}.{}".format(chunk_i, split)) for chunk_i in range(nchunks)]
+            out_prefix = str(datapath/self.dataset_name/split)
+            if output_format == "binary":
+                for ext in ["src", "trg"]:
+                    tripstore.merge_token_seqs([p+"."+ext for p in prefixes], out_prefix+"."+ext)
+                tripstore.merge_metas([p+".mta" for p in prefixes], out_prefix+".mta")
+                chunk_lines = [len(tripstore.TokenSeqStore(p+".src")) for p in prefixes]
+            else:
+                for ext in ["src", "trg", "mta"]:
+                    with open(out_prefix+"."+ext, "w") as out:
+                        lines = []
+                        for p in prefixes:
+                            lines.append(0)
+                            with open(p+"."+ext, "r") as part:
+                                for block in iter(lambda: part.read(1 << 20), ""):
+                                    out.write(block)
+                                    lines[-1] += block.count("\n")
+                    if ext == "src":
+                        chunk_lines = lines
+            line_start = 0
+            for chunk_i, lines in enumerate(chunk_lines):
+                index[split].append({"chunk": chunk_i,
+                                     "first_trip": chunk_i*chunk_size + 1,
+                                     "last_trip": min((chunk_i+1)*chunk_size, ntrain+nval),
+                                     "line_start": line_start, "lines": lines})
+                line_start += lines
+        with open(datapath/self.dataset_name/"trainval.index.json", "w") as f:
+            json.dump(index, f)
+        shutil.rmtree(parts_dir)
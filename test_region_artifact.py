@@ -0,0 +1,40 @@
+import numpy as np
+
+from preprocessing import SpatialRegion
+
+
+def make_region():
+    region = SpatialRegion("test", minlon=-8.70, minlat=41.10, maxlon=-8.60, maxlat=41.20,
+                           xstep=500, ystep=500)
+    rng = np.random.RandomState(0)
+    counts = rng.randint(1, 100, 60)
+    region.hotcell = rng.choice(region.numx*region.numy, 60, replace=False).astype(np.int64)
+    region.cellcount = dict(zip(region.hotcell.tolist(), counts.tolist()))
+    region.vocab_size = region.vocab_start + len(region.hotcell)
+    region.built = True
+    region.build_cell2vocab()
+    return region
+
+
+def load_region(data_dir, fname):
+    region = SpatialRegion("test", minlon=-8.70, minlat=41.10, maxlon=-8.60, maxlat=41.20,
+                           xstep=500, ystep=500)
+    region.load_spatialregion_info(data_dir, fname)
+    return region
+
+
+def test_resave_loaded_region(tmp_path):
+    region = make_region()
+    region.save_spatialregion_info(tmp_path, "region.pkl")
+
+    # the loaded arrays are memmaps of the artifact files being rewritten
+    loaded = load_region(tmp_path, "region.pkl")
+    assert isinstance(loaded.hotcell, np.memmap)
+    loaded.save_spatialregion_info(tmp_path, "region.pkl")
+
+    reloaded = load_region(tmp_path, "region.pkl")
+    assert np.array_equal(reloaded.hotcell, region.hotcell)
+    assert np.array_equal(reloaded.cell2vocab, region.cell2vocab)
+    assert reloaded.cellcount == region.cellcount
+    assert reloaded.vocab_size == region.vocab_size
+    assert sorted(p.name for p in (tmp_path/"test"/"region_info").iterdir()) == ["region.pkl", "region.region"]
@@ -0,0 +1,573 @@
+"""
+Consolidated (ragged) trip layout
+
+    points  : (2, #points) float64, every trip concatenated along axis 1
+    offsets : (#trips+1,) int64, trip i is points[:, offsets[i]:offsets[i+1]]
+    tripids : (#trips,) int64, ascending trip numbers (the numbering of porto2h5)
+    start_time : (#trips,) int64, timestamp of the first point of each trip
+    interval : (#trips,) int32, sampling interval in seconds (15 for porto)
+    timestamps : optional (#points,) int64 explicit timestamps, only for irregular sources
+
+Timestamps of regular trips are never stored, they are materialized from
+start_time + k*interval when asked for.
+A full pass is a few large sequential reads instead of one dataset lookup per trip.
+RaggedTripStore reads the layout from one .h5 file, MemmapTripStore from .npy files.
+"""
+import os
+
+import h5py
+import numpy as np
+
+DEFAULT_INTERVAL = 15
+CODECS = ["none", "gzip", "lz4", "blosc"]
+
+
+def h5_dataset_kwargs(shape, dtype, codec=None, level=None, chunk=None):
+    """
+    create_dataset keyword arguments for the writer options of our .h5 outputs
+
+    @param codec : "none" | "gzip" | "lz4" | "blosc" (lz4/blosc need the hdf5plugin package)
+    @param level : compression level (gzip 0~9, blosc 0~9; lz4 has none)
+    @param chunk : chunk length along the last axis, None lets h5py choose
+    empty, scalar and non-numeric datasets are always written contiguous and uncompressed
+    """
+    shape, dtype = tuple(shape), np.dtype(dtype)
+    if len(shape) == 0 or 0 in shape or dtype.kind not in "biuf":
+        return {}
+
+    kwargs = {}
+    if codec in (None, "none"):
+        pass
+    elif codec == "gzip":
+        kwargs.update(compression="gzip", compression_opts=4 if level is None else level)
+    elif codec in ("lz4", "blosc"):
+        try:
+            import hdf5plugin
+        except ImportError:
+            raise ImportError("codec '{}' needs hdf5plugin: pip install hdf5plugin".format(codec))
+        if codec == "lz4":
+            kwargs.update(hdf5plugin.LZ4())
+        else:
+            kwargs.update(hdf5plugin.Blosc(cname="lz4", clevel=5 if level is None else level,
+                                           shuffle=hdf5plugin.Blosc.SHUFFLE))
+    else:
+        raise ValueError("unknown codec '{}', expected one of {}".format(codec, CODECS))
+
+    if chunk:
+        kwargs["chunks"] = shape[:-1] + (max(1, min(chunk, shape[-1])),)
+    return kwargs
+
+
+def h5_write(group, name, data, h5opts=None):
+    """
+    group[name] = data with the writer options h5opts = {"codec":..., "level":..., "chunk":...}
+    """
+    data = np.asarray(data)
+    return group.create_dataset(name, data=data,
+                                **h5_dataset_kwargs(data.shape, data.dtype, **(h5opts or {})))
+
+
+def ragged_gather(starts, lengths):
+    """
+    flat indices of the segments [starts[i], starts[i]+lengths[i]) laid end to end
+    """
+    starts = np.asarray(starts, dtype=np.int64)
+    lengths = np.asarray(lengths, dtype=np.int64)
+    seg_starts = np.cumsum(lengths) - lengths
+    return np.repeat(starts - seg_starts, lengths) + np.arange(lengths.sum())
+
+
+def write_link_index(fname, links):
+    """
+    index file of external links, f["link_{start}"] -> root of the file holding samples from start
+    (the merged index read by dataloader.TrajDataset)
+
+    @param links : list of (start, path)
+    """
+    with h5py.File(fname, "w") as f:
+        for start, path in sorted(links, key=lambda x: x[0]):
+            f["link_{}".format(start)] = h5py.ExternalLink(str(path), "/")
+
+
+def write_ragged(fname, tripids, trips, start_time=None, interval=DEFAULT_INTERVAL, timestamps=None,
+                 h5opts=None):
+    """
+    write trips to fname in the ragged layout, sorted by tripids
+
+    @param tripids : (#trips,)
+    @param trips : list of (2, traj_len) nd.array
+    @param start_time : (#trips,) or None(0)
+    @param interval : scalar or (#trips,)
+    @param timestamps : list of (traj_len,) nd.array for irregular sources, or None
+    @param h5opts : writer options, see h5_dataset_kwargs
+    """
+    tripids = np.asarray(tripids, dtype=np.int64)
+    order = np.argsort(tripids, kind="stable")
+    start_time = np.zeros(len(tripids), dtype=np.int64) if start_time is None else start_time
+    start_time = np.asarray(start_time, dtype=np.int64)
+    interval = np.broadcast_to(np.asarray(interval, dtype=np.int32), tripids.shape)
+    lengths = np.array([trips[i].shape[1] for i in order], dtype=np.int64)
+    offsets = np.zeros(len(order)+1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    if len(order):
+        points = np.concatenate([trips[i] for i in order], axis=1).astype(np.float64)
+    else:
+        points = np.empty((2, 0), dtype=np.float64)
+
+    with h5py.File(fname, "w") as f:
+        h5_write(f, "points", points, h5opts)
+        h5_write(f, "offsets", offsets, h5opts)
+        h5_write(f, "tripids", tripids[order], h5opts)
+        h5_write(f, "start_time", start_time[order], h5opts)
+        h5_write(f, "interval", interval[order], h5opts)
+        if timestamps is not None:
+            h5_write(f, "timestamps", np.concatenate([np.asarray(timestamps[i], dtype=np.int64) for i in order]
+                                                     + [np.empty(0, dtype=np.int64)]), h5opts)
+
+
+def merge_ragged(part_fnames, fname, block_size=100000, h5opts=None):
+    """
+    merge ragged part files, each sorted by tripid, into one ragged file
+    blocks of block_size trips are assembled at a time, so memory stays bounded
+    @param h5opts : writer options of the merged file, see h5_dataset_kwargs
+    """
+    parts = [RaggedTripStore(part) for part in part_fnames]
+    try:
+        all_ids = np.concatenate([part.tripids for part in parts] + [np.empty(0, dtype=np.int64)])
+        all_lens = np.concatenate([np.diff(part.offsets) for part in parts] + [np.empty(0, dtype=np.int64)])
+        all_starts = np.concatenate([part.start_time for part in parts] + [np.empty(0, dtype=np.int64)])
+        all_intervals = np.concatenate([part.interval for part in parts] + [np.empty(0, dtype=np.int32)])
+        explicit = len(parts) > 0 and all(part.timestamps is not None for part in parts)
+        order = np.argsort(all_ids, kind="stable")
+        tripids, lengths = all_ids[order], all_lens[order]
+        if np.any(tripids[1:] == tripids[:-1]):
+            raise ValueError("duplicated trip ids across parts")
+        offsets = np.zeros(len(tripids)+1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+
+        with h5py.File(fname, "w") as f:
+            points = f.create_dataset("points", (2, offsets[-1]), dtype=np.float64,
+                                      **h5_dataset_kwargs((2, offsets[-1]), np.float64, **(h5opts or {})))
+            h5_write(f, "offsets", offsets, h5opts)
+            h5_write(f, "tripids", tripids, h5opts)
+            h5_write(f, "start_time", all_starts[order], h5opts)
+            h5_write(f, "interval", all_intervals[order], h5opts)
+            if explicit:
+                timestamps = f.create_dataset("timestamps", (offsets[-1],), dtype=np.int64,
+                                              **h5_dataset_kwargs((offsets[-1],), np.int64, **(h5opts or {})))
+
+            for b in range(0, len(tripids), block_size):
+                e = min(b + block_size, len(tripids))
+                lo, hi = tripids[b], tripids[e-1] + 1
+
+                blk_ids, blk_starts, blk_lens, blk_points, blk_times = [], [], [], [], []
+                base = 0
+                for part in parts:
+                    s_, e_ = np.searchsorted(part.tripids, [lo, hi])
+                    if s_ == e_ : continue
+                    part_offsets = part.offsets[s_:e_+1]
+                    blk_ids.append(part.tripids[s_:e_])
+                    blk_starts.append(part_offsets[:-1] - part_offsets[0] + base)
+                    blk_lens.append(np.diff(part_offsets))
+                    blk_points.append(part.points[:, part_offsets[0]:part_offsets[-1]])
+                    if explicit:
+                        blk_times.append(part.timestamps[part_offsets[0]:part_offsets[-1]])
+                    base += part_offsets[-1] - part_offsets[0]
+
+                blk_ids, blk_starts = np.concatenate(blk_ids), np.concatenate(blk_starts)
+                blk_lens, blk_points = np.concatenate(blk_lens), np.concatenate(blk_points, axis=1)
+                perm = np.argsort(blk_ids, kind="stable")
+                gather = ragged_gather(blk_starts[perm], blk_lens[perm])
+                points[:, offsets[b]:offsets[e]] = blk_points[:, gather]
+                if explicit:
+                    timestamps[offsets[b]:offsets[e]] = np.concatenate(blk_times)[gather]
+    finally:
+        for part in parts:
+            part.close()
+
+
+class _RaggedTrips(object):
+    """
+    access on self.points, self.offsets, self.tripids shared by the stores
+
+    store.get(trip_id) -> (2, traj_len)
+    store[i:j] -> (tripids, trips) of positions i~j in a single read
+    for trip_id, trip in store: ... (full scan by large blocks)
+    """
+    def __len__(self):
+        return len(self.tripids)
+
+    def __contains__(self, trip_id):
+        i = np.searchsorted(self.tripids, trip_id)
+        return i < len(self.tripids) and self.tripids[i] == trip_id
+
+    def index(self, trip_id):
+        """
+        position of trip_id in the store
+        """
+        i = np.searchsorted(self.tripids, trip_id)
+        if not (i < len(self.tripids) and self.tripids[i] == trip_id):
+            raise KeyError(trip_id)
+        return i
+
+    def get(self, trip_id):
+        i = self.index(trip_id)
+        return self.points[:, self.offsets[i]:self.offsets[i+1]]
+
+    def get_timestamps(self, trip_id, absolute=True):
+        """
+        timestamps of a trip, materialized from start_time + k*interval
+        (or read from the explicit timestamps of irregular sources)
+        absolute=False gives seconds from the trip start, like /timestamps/{num} of porto2h5
+        """
+        i = self.index(trip_id)
+        if self.timestamps is not None:
+            times = np.asarray(self.timestamps[self.offsets[i]:self.offsets[i+1]])
+        else:
+            length = self.offsets[i+1] - self.offsets[i]
+            times = self.start_time[i] + np.arange(length, dtype=np.int64) * self.interval[i]
+        return times if absolute else times - self.start_time[i]
+
+    def get_range(self, start, stop):
+        """
+        trips at positions start~stop read at once
+        return tripids : (stop-start,), trips : list of (2, traj_len)
+        """
+        start, stop, _ = slice(start, stop).indices(len(self))
+        stop = max(start, stop)
+        s, e = self.offsets[start], self.offsets[stop]
+        block = self.points[:, s:e]
+        return self.tripids[start:stop], np.split(block, self.offsets[start+1:stop] - s, axis=1)
+
+    def get_id_range(self, start_id, stop_id):
+        """
+        trips with start_id <= trip_id < stop_id
+        """
+        start, stop = np.searchsorted(self.tripids, [start_id, stop_id])
+        return self.get_range(start, stop)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            if key.step not in (None, 1):
+                raise ValueError("step is not supported")
+            return self.get_range(key.start, key.stop)
+        return self.get(key)
+
+    def iter_chunks(self, chunk_size=100000, start=0, stop=None):
+        """
+        yield (tripids, trips) for consecutive blocks of chunk_size trips
+        """
+        stop = len(self) if stop is None else stop
+        for s in range(start, stop, chunk_size):
+            yield self.get_range(s, min(s + chunk_size, stop))
+
+    def __iter__(self):
+        for tripids, trips in self.iter_chunks():
+            for trip_id, trip in zip(tripids, trips):
+                yield trip_id, trip
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class RaggedTripStore(_RaggedTrips):
+    """
+    reader of the ragged layout in a single .h5 file
+    """
+    def __init__(self, fname):
+        self.fname = fname
+        self.f = h5py.File(fname, "r")
+        self.points = self.f["points"]
+        self.offsets = self.f["offsets"][()]
+        self.tripids = self.f["tripids"][()]
+        self.start_time, self.interval = _time_arrays(self.f, len(self.tripids))
+        self.timestamps = self.f["timestamps"] if "timestamps" in self.f else None
+
+    def __getstate__(self):
+        # h5py handles cannot be pickled, workers reopen the file
+        return {"fname": self.fname}
+
+    def __setstate__(self, state):
+        self.__init__(state["fname"])
+
+    def close(self):
+        self.f.close()
+
+
+class MemmapTripStore(_RaggedTrips):
+    """
+    np.memmap-backed ragged layout in a directory (points.npy, offsets.npy, tripids.npy,
+    start_time.npy, interval.npy and optionally timestamps.npy)
+
+    get(trip_id) hands out a zero-copy (2, traj_len) view, and every process that
+    opens (or unpickles) the store shares the same page cache instead of its own copy
+    """
+    def __init__(self, dirname):
+        self.dirname = dirname
+        self.points = np.load(os.path.join(dirname, "points.npy"), mmap_mode="r")
+        self.offsets = np.load(os.path.join(dirname, "offsets.npy"), mmap_mode="r")
+        self.tripids = np.load(os.path.join(dirname, "tripids.npy"), mmap_mode="r")
+        arrays = {}
+        for name in ["start_time", "interval", "timestamps"]:
+            path = os.path.join(dirname, name + ".npy")
+            if os.path.exists(path):
+                arrays[name] = np.load(path, mmap_mode="r")
+        self.start_time, self.interval = _time_arrays(arrays, len(self.tripids))
+        self.timestamps = arrays.get("timestamps")
+
+    def __getstate__(self):
+        return {"dirname": self.dirname}
+
+    def __setstate__(self, state):
+        self.__init__(state["dirname"])
+
+    def close(self):
+        self.points, self.offsets, self.tripids = None, None, None
+        self.start_time, self.interval, self.timestamps = None, None, None
+
+
+def _time_arrays(arrays, ntrips):
+    # stores written before start_time/interval existed hold relative 15 s timestamps
+    start_time = arrays["start_time"] if "start_time" in arrays else np.zeros(ntrips, dtype=np.int64)
+    interval = arrays["interval"] if "interval" in arrays else np.full(ntrips, DEFAULT_INTERVAL, dtype=np.int32)
+    return np.asarray(start_time), np.asarray(interval)
+
+
+def ragged2memmap(fname, dirname, block_size=1000000):
+    """
+    convert a ragged .h5 file into the directory read by MemmapTripStore
+    points are copied by blocks of block_size trips
+    """
+    os.makedirs(dirname, exist_ok=True)
+    with RaggedTripStore(fname) as store:
+        np.save(os.path.join(dirname, "offsets.npy"), store.offsets)
+        np.save(os.path.join(dirname, "tripids.npy"), store.tripids)
+        np.save(os.path.join(dirname, "start_time.npy"), store.start_time)
+        np.save(os.path.join(dirname, "interval.npy"), store.interval)
+        if store.timestamps is not None:
+            np.save(os.path.join(dirname, "timestamps.npy"), store.timestamps[()])
+        points = np.lib.format.open_memmap(os.path.join(dirname, "points.npy"), mode="w+",
+                                           dtype=store.points.dtype, shape=store.points.shape)
+        for s in range(0, len(store), block_size):
+            e = min(s + block_size, len(store))
+            points[:, store.offsets[s]:store.offsets[e]] = store.points[:, store.offsets[s]:store.offsets[e]]
+        points.flush()
+        del points
+
+
+def open_trips(trips_path):
+    """
+    MemmapTripStore for a directory, RaggedTripStore for a ragged .h5 file
+    """
+    if os.path.isdir(trips_path):
+        return MemmapTripStore(trips_path)
+    return RaggedTripStore(trips_path)
+
+
+def is_ragged(trips_path):
+    if os.path.isdir(trips_path):
+        return True
+    with h5py.File(trips_path, "r") as f:
+        return "offsets" in f
+
+
+def tripnum_ranges(trips_path, chunk_size):
+    """
+    [(start, stop), ...] trip numbers 1~last by ranges of chunk_size, inclusive bounds as in iter_trips
+    """
+    if is_ragged(trips_path):
+        with open_trips(trips_path) as store:
+            last_num = int(store.tripids[-1]) if len(store) else 0
+    else:
+        with h5py.File(trips_path, "r") as f:
+            last_num = len(f["trips"].keys())
+    return [(start, min(start + chunk_size - 1, last_num)) for start in range(1, last_num + 1, chunk_size)]
+
+
+def iter_trips(trips_path, zerolen_tripids=None, stop=None, chunk_size=100000, start=1):
+    """
+    yield (num, trip) where trip : (2, traj_len) nd.array, for either layout
+
+    per-trip layout : f["trips/{num}"] for num in start~stop, stop defaults to len(f["trips"])
+    ragged layout (.h5 or memmap directory) : every stored trip with start <= num <= stop,
+                                              read by large blocks
+    @param zerolen_tripids : trip numbers to skip
+    """
+    zerolen_tripids = set(zerolen_tripids) if zerolen_tripids is not None else set()
+
+    if is_ragged(trips_path):
+        with open_trips(trips_path) as store:
+            begin = np.searchsorted(store.tripids, start)
+            end = len(store) if stop is None else np.searchsorted(store.tripids, stop, side="right")
+            for tripids, trips in store.iter_chunks(chunk_size, start=begin, stop=end):
+                for num, trip in zip(tripids, trips):
+                    if num in zerolen_tripids: continue
+                    yield int(num), trip
+    else:
+        with h5py.File(trips_path, "r") as f:
+            if stop is None:
+                stop = len(f["trips"].keys())
+            for num in range(start, stop+1):
+                if num in zerolen_tripids: continue
+                yield num, f["trips/"+str(num)][()] # nd.array (2,traj_len)
+
+
+# ragged token sequences of createTrainVal in binary form :
+#     {prefix}.tokens.npy  : (#tokens,) int32, every sequence concatenated, UNK stored as 0 (Constants.UNK)
+#     {prefix}.offsets.npy : (#seqs+1,) int64, sequence i is tokens[offsets[i]:offsets[i+1]]
+#     {prefix}.npy         : (#seqs, 2) float32 for the meta (.mta) lines
+# line i of train.src, train.trg and train.mta is entry i of the three prefixes
+
+class TokenSeqWriter(object):
+    """
+    append int32 token sequences to {prefix}.tokens.npy / {prefix}.offsets.npy
+    tokens are streamed to a temporary file and turned into .npy by close()
+    """
+    def __init__(self, prefix):
+        self.prefix = str(prefix)
+        self.lengths = []
+        self.tmp = open(self.prefix + ".tokens.tmp", "wb")
+
+    def append(self, seq):
+        seq = np.asarray(seq, dtype=np.int32)
+        self.tmp.write(seq.tobytes())
+        self.lengths.append(len(seq))
+
+    def close(self):
+        self.tmp.close()
+        offsets = np.zeros(len(self.lengths) + 1, dtype=np.int64)
+        np.cumsum(self.lengths, out=offsets[1:])
+        _raw2npy(self.prefix + ".tokens.tmp", self.prefix + ".tokens.npy", np.int32, offsets[-1])
+        np.save(self.prefix + ".offsets.npy", offsets)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class MetaWriter(object):
+    """
+    append (xoffset, yoffset) meta rows, saved as {prefix}.npy (#seqs, 2) float32 by close()
+    rows are streamed to a temporary file in blocks of block_size rows
+    """
+    def __init__(self, prefix, block_size=65536):
+        self.prefix = str(prefix)
+        self.block_size = block_size
+        self.rows = []
+        self.nrows = 0
+        self.tmp = open(self.prefix + ".tmp", "wb")
+
+    def append(self, meta):
+        self.rows.append(meta)
+        if len(self.rows) >= self.block_size:
+            self.flush()
+
+    def flush(self):
+        block = np.asarray(self.rows, dtype=np.float32).reshape(-1, 2)
+        self.tmp.write(block.tobytes())
+        self.nrows += len(block)
+        self.rows = []
+
+    def close(self):
+        self.flush()
+        self.tmp.close()
+        _raw2npy(self.prefix + ".tmp", self.prefix + ".npy", np.float32, self.nrows * 2, shape=(self.nrows, 2))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _raw2npy(tmp_path, path, dtype, length, block_size=1 << 24, shape=None):
+    """
+    copy length raw values of tmp_path into the .npy file path, of the given shape (default (length,))
+    """
+    out = np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=shape or (int(length),))
+    flat = out.reshape(-1)
+    with open(tmp_path, "rb") as f:
+        for s in range(0, int(length), block_size):
+            block = np.frombuffer(f.read(block_size * np.dtype(dtype).itemsize), dtype=dtype)
+            flat[s:s + len(block)] = block
+    out.flush()
+    del flat, out
+    os.remove(tmp_path)
+
+
+class TokenSeqStore(object):
+    """
+    np.memmap reader of {prefix}.tokens.npy / {prefix}.offsets.npy
+    store[i] is a zero-copy int32 view of sequence i, no text is parsed
+    """
+    def __init__(self, prefix):
+        self.prefix = str(prefix)
+        self.tokens = np.load(self.prefix + ".tokens.npy", mmap_mode="r")
+        self.offsets = np.load(self.prefix + ".offsets.npy", mmap_mode="r")
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        return self.tokens[self.offsets[i]:self.offsets[i+1]]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getstate__(self):
+        return {"prefix": self.prefix}
+
+    def __setstate__(self, state):
+        self.__init__(state["prefix"])
+
+    @staticmethod
+    def exists(prefix):
+        return os.path.exists(str(prefix) + ".tokens.npy")
+
+
+def merge_token_seqs(prefixes, prefix):
+    """
+    concatenate the token sequences of prefixes, in order, into prefix
+    """
+    stores = [TokenSeqStore(p) for p in prefixes]
+    ntokens = sum(len(store.tokens) for store in stores)
+    offsets = [np.zeros(1, dtype=np.int64)]
+    tokens = np.lib.format.open_memmap(str(prefix) + ".tokens.npy", mode="w+", dtype=np.int32, shape=(ntokens,))
+    s = 0
+    for store in stores:
+        tokens[s:s + len(store.tokens)] = store.tokens
+        offsets.append(store.offsets[1:] + s)
+        s += len(store.tokens)
+    tokens.flush()
+    del tokens
+    np.save(str(prefix) + ".offsets.npy", np.concatenate(offsets))
+
+
+def merge_metas(prefixes, prefix):
+    metas = [np.load(str(p) + ".npy") for p in prefixes]
+    np.save(str(prefix) + ".npy", np.concatenate(metas).astype(np.float32).reshape(-1, 2))
+
+
+def text2tokens(text_path, prefix):
+    """
+    convert a .src/.trg text file of createTrainVal ("UNK" or vocab per token) into prefix
+    """
+    with open(text_path, "r") as f, TokenSeqWriter(prefix) as writer:
+        for line in f:
+            writer.append(np.array(line.replace("UNK", "0").split(), dtype=np.int32))
+
+
+def text2metas(text_path, prefix):
+    """
+    convert a .mta text file of createTrainVal into prefix.npy
+    """
+    metas = np.loadtxt(text_path, dtype=np.float32, ndmin=2)
+    np.save(str(prefix) + ".npy", metas.reshape(-1, 2))